@@ -1,10 +1,110 @@
 import os
+import threading
+import time
+from datetime import datetime
 from flask import (Flask, request, abort, jsonify, render_template)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, Actor, Movie, rollback
-from auth import requires_auth, AuthError
+from models import (setup_db, db as models_db, Actor, Movie, Stat, Change,
+                    VersionConflict, rollback)
+from auth import requires_auth, authenticate, AuthError, PAYLOAD_KEY
 from flask_migrate import Migrate
+from profiling import init_profiler, init_query_cache_log
+from request_log import init_logging
+import catalog
+import health
+from schemas import ACTOR, MOVIE, ValidationError
+
+
+# /changes paging and long-poll limits (setup.sh)
+CHANGES_PAGE_SIZE = int(os.environ.get('CHANGES_PAGE_SIZE', 100))
+CHANGES_MAX_PAGE_SIZE = int(os.environ.get('CHANGES_MAX_PAGE_SIZE', 1000))
+CHANGES_MAX_WAIT = float(os.environ.get('CHANGES_MAX_WAIT', 30))
+CHANGES_POLL_INTERVAL = 0.5
+# long-polls held at once per worker, keep it below gunicorn's --threads
+# so waiting clients never take every thread
+CHANGES_MAX_WAITERS = int(os.environ.get('CHANGES_MAX_WAITERS', 4))
+_waiters = threading.BoundedSemaphore(CHANGES_MAX_WAITERS)
+
+# Most ids accepted by a single ?ids= multi-get
+MAX_IDS = int(os.environ.get('MAX_IDS', 200))
+
+# Most operations accepted by a single /batch call
+MAX_BATCH_OPERATIONS = int(os.environ.get('MAX_BATCH_OPERATIONS', 50))
+BATCH_METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+
+
+def requested_ids():
+    # ?ids=3,1,2 -> [3, 1, 2], duplicates dropped, request order kept
+    ids = request.args.get('ids')
+    if ids is None:
+        return None
+
+    try:
+        ids = [int(i) for i in ids.split(',') if i.strip()]
+    except ValueError:
+        abort(400)
+
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > MAX_IDS:
+        abort(400)
+    return ids
+
+
+def date_arg(name):
+    # ?released_after=2001-02-01
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+
+def batch_operations(body):
+    # [{"method": "PATCH", "path": "/actors/1", "body": {...}}, ...]
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        abort(400)
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        abort(400)
+
+    for operation in operations:
+        if not isinstance(operation, dict):
+            abort(400)
+        method = str(operation.get('method', '')).upper()
+        path = operation.get('path')
+        if method not in BATCH_METHODS:
+            abort(400)
+        if not isinstance(path, str) or not path.startswith('/'):
+            abort(400)
+        if path.split('?')[0].rstrip('/') == '/batch':
+            abort(400)
+        if not isinstance(operation.get('headers', {}), dict):
+            abort(400)
+        operation['method'] = method
+    return operations
+
+
+def if_match_version():
+    # the version a client expects to change, from an If-Match: "<version>"
+    etags = request.if_match
+    if not etags or etags.star_tag:
+        return None
+
+    versions = etags.as_set()
+    if len(versions) != 1:
+        abort(400)
+    try:
+        return int(versions.pop())
+    except ValueError:
+        abort(400)
+
+
+def with_etag(response, row):
+    response.set_etag(str(row.version))
+    return response
 
 
 def create_app(test_config=None):
@@ -12,20 +112,29 @@ def create_app(test_config=None):
     # create and configure the app
 
     app = Flask(__name__)
+    init_logging(app)
     setup_db(app)
     CORS(app)
     db = SQLAlchemy(app)
     migrate = Migrate(app, db)
+    init_profiler(app)
+    init_query_cache_log(app)
+    catalog.init_catalog(app)
+    health.install_drain_handler()
 
     @app.after_request
     def after_request(response):
         response.headers.add(
-            'Access-Control-Allow-Headers', 'Content-Type, Authorization, true'
+            'Access-Control-Allow-Headers',
+            'Content-Type, Authorization, If-Match, X-Request-ID, true'
         )
         response.headers.add(
             'Access-Control-Allow-Methods', 'PUT, GET, POST, DELETE, OPTIONS'
         )
         response.headers.add('Access-Control-Allow-origins', '*')
+        response.headers.add(
+            'Access-Control-Expose-Headers', 'ETag, X-Request-ID'
+        )
         return response
 
     # create the actors action here
@@ -33,13 +142,42 @@ def create_app(test_config=None):
     def start():
         return "<h1> This is my Final Project :) </h1>"
 
+    # Liveness: the worker is up, dependency checks are informational
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({
+            "success": True,
+            "status": "draining" if health.draining.is_set() else "alive",
+            "checks": health.run_checks()
+        })
+
+    # Readiness: 503 while draining, loading or a dependency is down
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        ready, status, checks = health.readiness()
+        return jsonify({
+            "success": ready,
+            "status": status,
+            "checks": checks
+        }), 200 if ready else 503
+
     # Get actors
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
     def get_actors(jwt):
+        ids = requested_ids()
+        if ids is not None:
+            # Get many actors by id in one query
+            found = {actor.id: actor for actor in catalog.get_actors(ids)}
+            return jsonify({
+                'success': True,
+                'actors': [found[i].format() for i in ids if i in found],
+                'missing': [i for i in ids if i not in found]
+            }), 200
+
         # Get all actors route
-        actors = Actor.query.all()
+        actors = catalog.all_actors(name=request.args.get('name'))
 
         return jsonify({
             'success': True,
@@ -51,107 +189,241 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['GET'])
     @requires_auth('get:actors')
     def get_actor(jwt, actor_id):
-        actor = Actor.query.get(actor_id)
+        actor = catalog.get_actor(actor_id)
         if actor is None:
             abort(404)
 
-        return jsonify({
+        return with_etag(jsonify({
             "success": True,
             "actor": actor.format()
-        }), 200
+        }), actor), 200
 
     # post actor
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
     def post_actors(jwt):
-        body = request.get_json()
-
-        name = body.get('name')
-        age = body.get('age')
-        gender = body.get('gender')
-
-        if (name is None) or (age is None) or (gender is None):
-            abort(422)
+        values = ACTOR.validate(request.get_json(silent=True))
         try:
-            new_actor = Actor(
-                name=name,
-                gender=gender,
-                age=age
-            )
+            new_actor = Actor(**values)
 
             new_actor.insert()
         except Exception:
+            rollback()
             abort(500)
 
-        return jsonify({
+        return with_etag(jsonify({
             "success": True,
             "created_actor": new_actor.format()
-        }), 200
+        }), new_actor), 200
 
     # patch the data
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def edit_actors(jwt, actor_id):
-        body = request.get_json()
-
-        actor = Actor.query.get(actor_id)
-
-        if actor is None:
-            abort(404)
-
-        new_name = body.get('name')
-        new_age = body.get('age')
-        new_gender = body.get('gender')
-
-        if (new_name is None) or (new_age is None) or (new_gender is None):
-            abort(422)
+        values = ACTOR.validate(request.get_json(silent=True))
 
+        expected_version = if_match_version()
         try:
-            if new_name is not None:
-                actor.name = new_name
-            if new_age is not None:
-                actor.age = new_age
-            if new_gender is not None:
-                actor.gender = new_gender
-
-            actor.update()
-        except:
+            actor = Actor.update_by_id(
+                actor_id,
+                expected_version=expected_version,
+                **values
+            )
+        except VersionConflict:
+            rollback()
+            abort(412)
+        except Exception:
             rollback()
             abort(422)
 
-        return jsonify({
+        if actor is None:
+            abort(404)
+
+        return with_etag(jsonify({
             "success": True,
             "patched_actor": actor.format()
-        }), 200
+        }), actor), 200
 
     # get the actor by id
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actors(jwt, actor_id):
-        actor = Actor.query.get(actor_id)
-        if actor is None:
-            abort(404)
-
+        expected_version = if_match_version()
         try:
-            actor.delete()
-            return jsonify({
-                "success": True,
-                "deleted_actor": actor.format()
-            }), 200
-
+            actor = Actor.delete_by_id(
+                actor_id,
+                expected_version=expected_version
+            )
+        except VersionConflict:
+            rollback()
+            abort(412)
         except Exception:
             rollback()
             abort(500)
 
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "deleted_actor": actor.format()
+        }), 200
+
+    # Get catalog statistics
+
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_stats(jwt):
+        # served from the stats counters, not from the catalog tables
+        stats = Stat.summary()
+        # movie statistics only with get:movies, as in /changes
+        if 'get:movies' not in jwt['permissions']:
+            del stats['movies']
+        return jsonify({
+            "success": True,
+            "stats": stats
+        }), 200
+
+    # Get the changes made after a cursor
+
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_changes(jwt):
+        since = request.args.get('since', 0, type=int)
+        limit = request.args.get('limit', CHANGES_PAGE_SIZE, type=int)
+        wait = request.args.get('wait', 0, type=float)
+
+        if limit < 1:
+            abort(400)
+        limit = min(limit, CHANGES_MAX_PAGE_SIZE)
+        deadline = time.monotonic() + min(max(wait, 0), CHANGES_MAX_WAIT)
+
+        tables = ['actors']
+        if 'get:movies' in jwt['permissions']:
+            tables.append('movies')
+
+        changes = Change.since(since, limit, tables)
+        # long-poll: wait for the first change instead of returning empty;
+        # with every waiter slot taken the page is returned straight away
+        if not changes and wait > 0 and _waiters.acquire(blocking=False):
+            try:
+                while not changes and time.monotonic() < deadline:
+                    # end the transaction so the connection goes back to
+                    # the pool, unless it is an atomic /batch's that has to
+                    # outlive the wait
+                    if not models_db.session().transaction.nested:
+                        rollback()
+                    time.sleep(CHANGES_POLL_INTERVAL)
+                    changes = Change.since(since, limit, tables)
+            finally:
+                _waiters.release()
+
+        return jsonify({
+            "success": True,
+            "changes": [change.format() for change in changes],
+            "cursor": changes[-1].id if changes else since,
+            "has_more": len(changes) == limit
+        }), 200
+
+    # Run many operations in one call
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        # verify the token once, each operation still checks its own
+        # permission through requires_auth
+        authenticate()
+
+        body = request.get_json()
+        operations = batch_operations(body)
+        atomic = bool(body.get('atomic', False))
+
+        def dispatch(operation):
+            headers = dict(operation.get('headers', {}))
+            headers['Authorization'] = request.headers.get('Authorization')
+            with app.test_request_context(
+                operation['path'],
+                method=operation['method'],
+                json=operation.get('body'),
+                headers=headers,
+                environ_base={PAYLOAD_KEY: authenticate()}
+            ):
+                response = app.full_dispatch_request()
+            return {
+                "status": response.status_code,
+                "headers": {"ETag": response.headers['ETag']}
+                if 'ETag' in response.headers else {},
+                "body": response.get_json()
+            }
+
+        results = []
+        failed = False
+        for operation in operations:
+            if atomic and failed:
+                # not run: an earlier operation failed and was rolled back
+                results.append({"status": 424, "headers": {}, "body": None})
+                continue
+
+            if atomic:
+                # the views' own commits only release this savepoint
+                outer = models_db.session().transaction
+                savepoint = models_db.session.begin_nested()
+
+            result = dispatch(operation)
+
+            if atomic and not (outer.is_active and
+                               models_db.session().transaction
+                               in (savepoint, outer)):
+                # a second commit or rollback reached past the savepoint
+                # and ended the batch's own transaction
+                app.logger.error('%s %s ended the atomic batch transaction',
+                                 operation['method'], operation['path'])
+                result = {"status": 500, "headers": {}, "body": None}
+            results.append(result)
+            failed = failed or result['status'] >= 400
+
+            if atomic and savepoint.is_active:
+                savepoint.commit()
+
+        if atomic:
+            if failed:
+                rollback()
+                # earlier writes were undone with the failed one, their
+                # ids and ETags no longer exist
+                for result in results:
+                    if result['status'] < 400:
+                        result.update(status=424, headers={}, body=None)
+            else:
+                models_db.session.commit()
+
+        return jsonify({
+            "success": not failed,
+            "atomic": atomic,
+            "results": results
+        }), 200
+
     # Get movie
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_movies(jwt):
-        movies = Movie.query.all()
+        ids = requested_ids()
+        if ids is not None:
+            # Get many movies by id in one query
+            found = {movie.id: movie for movie in catalog.get_movies(ids)}
+            return jsonify({
+                "success": True,
+                "movies": [found[i].format() for i in ids if i in found],
+                "missing": [i for i in ids if i not in found]
+            })
+
+        movies = catalog.all_movies(
+            title=request.args.get('title'),
+            released_after=date_arg('released_after'),
+            released_before=date_arg('released_before')
+        )
 
         return jsonify({
             "success": True,
@@ -163,97 +435,86 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('get:movies')
     def get_movie(jwt, movie_id):
-        movie = Movie.query.get(movie_id)
+        movie = catalog.get_movie(movie_id)
         if movie is None:
             abort(404)
-        return jsonify({
+        return with_etag(jsonify({
             "success": True,
             "movie": [movie.format()]
-        })
+        }), movie)
 
     # Create movie
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
     def post_movies(jwt):
-
-        body = request.get_json()
-        title = body.get('title')
-        release_date = body.get('release_date')
-
-        if title is None or release_date is None:
-            abort(400)
-
+        values = MOVIE.validate(request.get_json(silent=True))
         try:
-            new_movie = Movie()
-            new_movie.title = title
-            new_movie.release_date = release_date
-
+            new_movie = Movie(**values)
             new_movie.insert()
+        except Exception:
+            rollback()
+            app.logger.exception('could not create movie')
+            abort(422)
 
-        except Exception as e:
-            print(e)
-
-        return jsonify({
+        return with_etag(jsonify({
                 'success': True,
                 'created_movie': new_movie.format()
-            }), 200
+            }), new_movie), 200
 
     @app.route('/movies/<int:id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def edit_movies(jwt, id):
+        values = MOVIE.validate(request.get_json(silent=True))
 
-        movie = Movie.query.get(id)
+        expected_version = if_match_version()
+        try:
+            movie = Movie.update_by_id(
+                id,
+                expected_version=expected_version,
+                **values
+            )
+        except VersionConflict:
+            rollback()
+            abort(412)
+        except Exception:
+            rollback()
+            # only look the movie up when the update failed
+            if Movie.get_one(id) is None:
+                abort(404)
+            abort(422)
 
         if movie is None:
             abort(404)
 
-        body = request.get_json()
-
-        title = body.get("title")
-        release_date = body.get("release_date")
-
-        if (title is None) or (release_date is None):
-            abort(422)
-
-        try:
-            if title is not None:
-                movie.title = title
-
-            if release_date is not None:
-                movie.relaese_date = release_date
-
-            movie.update()
-
-            return jsonify({
-                "success": True,
-                "patched_movie": movie.format()
-            }), 200
-
-        except Exception:
-            abort(422)
+        return with_etag(jsonify({
+            "success": True,
+            "patched_movie": movie.format()
+        }), movie), 200
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE', "GET"])
     @requires_auth('delete:movie')
     def delete_movie(jwt, movie_id):
+        expected_version = if_match_version()
         try:
-            movie = Movie.query.filter(
-                Movie.id == movie_id
-            ).one_or_none()
-
-            if movie is None:
-                abort(404)
-
-            movie.delete()
-
-            return jsonify({
-                'success': True,
-                'deleted_movie': movie.format()
-            }), 200
-
-        except:
+            movie = Movie.delete_by_id(
+                movie_id,
+                expected_version=expected_version
+            )
+        except VersionConflict:
+            rollback()
+            abort(412)
+        except Exception:
             rollback()
             abort(422)
 
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'deleted_movie': movie.format()
+        }), 200
+
 # Handle error
 
     @app.errorhandler(400)
@@ -288,6 +549,14 @@ def create_app(test_config=None):
             "message": "resource not found"
         }), 404
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "Precondition failed"
+        }), 412
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -304,6 +573,16 @@ def create_app(test_config=None):
             "message": "Internal server error"
         }), 500
 
+    @app.errorhandler(ValidationError)
+    def invalid_body(error):
+        return jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": ('Bad request' if error.status_code == 400
+                        else 'Unprocessable'),
+            "errors": error.errors
+        }), error.status_code
+
     @app.errorhandler(AuthError)
     def error(error):
         return jsonify({
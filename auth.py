@@ -59,7 +59,6 @@ def get_token_auth_header():
 
     # return the token part of the header
     token = spliting[1]
-    print()
     return token
 
 # check_permissions(permission, payload) method
@@ -78,12 +77,20 @@ def check_permissions(permission, payload):
             }, 401)
     return True
 
+# get_jwks() method
+
+
+def get_jwks(timeout=None):
+    jsonurl = urlopen(
+        "https://"+AUTH0_DOMAIN+"/.well-known/jwks.json", timeout=timeout
+    )
+    return json.loads(jsonurl.read())
+
 # verify_decode_jwt(token) method
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen("https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    jwks = get_jwks()
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
 
@@ -137,6 +144,32 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+# authenticate() method
+
+# verifies the token once per request and keeps the payload in the
+# request's environ; /batch sub-requests are handed it the same way
+# instead of decoding the token again. Not on g: g belongs to the app
+# context, which requests pushed inside an existing one share
+
+PAYLOAD_KEY = 'auth.jwt_payload'
+
+
+def authenticate():
+    payload = request.environ.get(PAYLOAD_KEY)
+    if payload is not None:
+        return payload
+
+    jwt = get_token_auth_header()
+
+    try:
+        payload = verify_decode_jwt(jwt)
+
+    except:
+        abort(401)
+
+    request.environ[PAYLOAD_KEY] = payload
+    return payload
+
 # @requires_auth(permission) decorator method
 
 
@@ -144,13 +177,7 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            jwt = get_token_auth_header()
-
-            try:
-                payload = verify_decode_jwt(jwt)
-
-            except:
-                abort(401)
+            payload = authenticate()
             check_permissions(permission, payload)
 
             return f(payload, *args, **kwargs)
@@ -0,0 +1,391 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from datetime import datetime
+
+from models import db, Actor, Movie
+
+logger = logging.getLogger('catalog')
+
+# In-memory catalog settings (setup.sh)
+CATALOG_SNAPSHOT = os.environ.get('CATALOG_SNAPSHOT', '0') == '1'
+CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL', 30))
+
+# Written by the notify_catalog_change() trigger, see the migration
+CHANNEL = 'catalog_changes'
+VERSION_SEQUENCE = 'catalog_version_seq'
+
+# (rows, sum of ids, sum of versions) of the committed actors and movies,
+# compared with the snapshot's when versions go missing
+CHECKSUMS = """
+    SELECT a.n, a.ids, a.versions, m.n, m.ids, m.versions FROM
+    (SELECT count(*) AS n, coalesce(sum(id), 0) AS ids,
+            coalesce(sum(version), 0) AS versions FROM actors) a,
+    (SELECT count(*) AS n, coalesce(sum(id), 0) AS ids,
+            coalesce(sum(version), 0) AS versions FROM movies) m
+"""
+
+
+# Compact rows, formatted like the models
+
+class ActorRow(namedtuple('ActorRow', 'id name age gender version')):
+    __slots__ = ()
+
+    def format(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "age": self.age,
+            "gender": self.gender
+        }
+
+
+class MovieRow(namedtuple('MovieRow', 'id title release_date version')):
+    __slots__ = ()
+
+    def format(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "release_date": self.release_date
+        }
+
+
+def _movie_row(row):
+    release_date = row['release_date']
+    if isinstance(release_date, str):
+        # row_to_json() renders timestamps in ISO 8601
+        release_date = datetime.fromisoformat(release_date)
+    return MovieRow(row['id'], row['title'], release_date, row['version'])
+
+
+def _actor_row(row):
+    return ActorRow(
+        row['id'], row['name'], row['age'], row['gender'], row['version']
+    )
+
+
+class CatalogSnapshot:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.ready = False
+        self.actors = {}
+        self.movies = {}
+        self.actors_by_name = {}
+        self.movies_by_title = {}
+        # sorted (release_date, id) pairs for range lookups
+        self.movies_by_date = []
+        # every change up to this version has been applied, later ones
+        # that arrived out of order wait in pending
+        self.version = 0
+        self.pending = set()
+        self.checked_version = None
+
+    # Loading and applying changes (listener thread)
+
+    def load(self, cursor):
+        # read the version first: changes committed while the tables are
+        # read arrive as notifications and are applied on top
+        cursor.execute(
+            'SELECT last_value, is_called FROM ' + VERSION_SEQUENCE
+        )
+        last_value, is_called = cursor.fetchone()
+
+        cursor.execute('SELECT id, name, age, gender, version FROM actors')
+        actors = {row[0]: ActorRow(*row) for row in cursor.fetchall()}
+        cursor.execute('SELECT id, title, release_date, version FROM movies')
+        movies = {row[0]: MovieRow(*row) for row in cursor.fetchall()}
+
+        actors_by_name = {}
+        for actor in actors.values():
+            actors_by_name.setdefault(actor.name, set()).add(actor.id)
+
+        with self.lock:
+            self.actors = actors
+            self.movies = movies
+            self.actors_by_name = actors_by_name
+            self.movies_by_title = {
+                movie.title: movie.id for movie in movies.values()
+            }
+            self.movies_by_date = sorted(
+                (movie.release_date, movie.id) for movie in movies.values()
+            )
+            self.version = last_value if is_called else 0
+            self.pending = set()
+            self.checked_version = None
+            self.ready = True
+
+        logger.info(
+            'catalog loaded: %d actors, %d movies at version %d',
+            len(actors), len(movies), self.version
+        )
+
+    def apply(self, change):
+        with self.lock:
+            if change['table'] == 'actors':
+                self._apply_actor(change)
+            else:
+                self._apply_movie(change)
+            self._seen(change['version'])
+
+    def _apply_actor(self, change):
+        old = self.actors.get(change['id'])
+        new = _actor_row(change['row']) if change['row'] else None
+        if old is not None and new is not None and old.version >= new.version:
+            return
+
+        if old is not None:
+            ids = self.actors_by_name[old.name]
+            ids.discard(old.id)
+            if not ids:
+                del self.actors_by_name[old.name]
+            del self.actors[old.id]
+        if new is not None:
+            self.actors[new.id] = new
+            self.actors_by_name.setdefault(new.name, set()).add(new.id)
+
+    def _apply_movie(self, change):
+        old = self.movies.get(change['id'])
+        new = _movie_row(change['row']) if change['row'] else None
+        if old is not None and new is not None and old.version >= new.version:
+            return
+
+        if old is not None:
+            if self.movies_by_title.get(old.title) == old.id:
+                del self.movies_by_title[old.title]
+            key = (old.release_date, old.id)
+            del self.movies_by_date[bisect_left(self.movies_by_date, key)]
+            del self.movies[old.id]
+        if new is not None:
+            self.movies[new.id] = new
+            self.movies_by_title[new.title] = new.id
+            insort(self.movies_by_date, (new.release_date, new.id))
+
+    def _seen(self, version):
+        if version <= self.version:
+            return
+        self.pending.add(version)
+        while self.version + 1 in self.pending:
+            self.version += 1
+            self.pending.remove(self.version)
+
+    def missed_changes(self, latest_version):
+        # the previous check's latest version when some version handed out
+        # by then has still not been seen, else None. nextval() is not
+        # undone by a rollback, so the change was either rolled back or
+        # its notification lost: the caller compares checksums() with the
+        # committed rows to tell which
+        previous, self.checked_version = self.checked_version, latest_version
+        if previous is not None and self.version < previous:
+            return previous
+        return None
+
+    def skip_to(self, version):
+        # the missing versions up to here were rolled back
+        with self.lock:
+            self.version = max(self.version, version)
+            self.pending = {v for v in self.pending if v > self.version}
+            while self.version + 1 in self.pending:
+                self.version += 1
+                self.pending.remove(self.version)
+
+    def checksums(self):
+        # the CHECKSUMS row for the rows in the snapshot
+        with self.lock:
+            sums = []
+            for rows in (self.actors, self.movies):
+                sums.extend([
+                    len(rows),
+                    sum(row.id for row in rows.values()),
+                    sum(row.version for row in rows.values())
+                ])
+            return tuple(sums)
+
+    # Reads (request handlers)
+
+    def all_actors(self, name=None):
+        with self.lock:
+            if name is None:
+                return list(self.actors.values())
+            ids = sorted(self.actors_by_name.get(name, ()))
+            return [self.actors[i] for i in ids]
+
+    def get_actor(self, actor_id):
+        return self.actors.get(actor_id)
+
+    def get_actors(self, actor_ids):
+        with self.lock:
+            return [self.actors[i] for i in actor_ids if i in self.actors]
+
+    def all_movies(self, title=None, released_after=None,
+                   released_before=None):
+        with self.lock:
+            if title is not None:
+                movie_id = self.movies_by_title.get(title)
+                movies = [] if movie_id is None else [self.movies[movie_id]]
+            elif released_after is None and released_before is None:
+                return list(self.movies.values())
+            else:
+                start, end = 0, len(self.movies_by_date)
+                if released_after is not None:
+                    start = bisect_left(
+                        self.movies_by_date, (released_after, 0)
+                    )
+                if released_before is not None:
+                    end = bisect_right(
+                        self.movies_by_date, (released_before, float('inf'))
+                    )
+                return [
+                    self.movies[movie_id]
+                    for _, movie_id in self.movies_by_date[start:end]
+                ]
+
+        return [
+            movie for movie in movies
+            if (released_after is None or
+                movie.release_date >= released_after) and
+            (released_before is None or
+             movie.release_date <= released_before)
+        ]
+
+    def get_movie(self, movie_id):
+        return self.movies.get(movie_id)
+
+    def get_movies(self, movie_ids):
+        with self.lock:
+            return [self.movies[i] for i in movie_ids if i in self.movies]
+
+
+snapshot = CatalogSnapshot()
+
+
+def serving():
+    return CATALOG_SNAPSHOT and snapshot.ready
+
+
+# Listener thread
+
+def _connect(engine):
+    # a dedicated connection, detached so it doesn't hold a pool slot
+    connection = engine.raw_connection()
+    connection.detach()
+    raw = connection.connection
+    raw.autocommit = True
+    return raw
+
+
+def _apply_notifications(connection, cursor):
+    connection.poll()
+    while connection.notifies:
+        change = json.loads(connection.notifies.pop(0).payload)
+        if change.get('reload'):
+            snapshot.load(cursor)
+        else:
+            snapshot.apply(change)
+
+
+def _matches_committed(connection, cursor):
+    cursor.execute(CHECKSUMS)
+    committed = tuple(cursor.fetchone())
+    # notifications for changes the query saw arrive with its result
+    _apply_notifications(connection, cursor)
+    return snapshot.checksums() == committed
+
+
+def listen(engine):
+    while True:
+        try:
+            connection = _connect(engine)
+            cursor = connection.cursor()
+            cursor.execute('LISTEN ' + CHANNEL)
+            # notifications may have been missed while disconnected
+            snapshot.load(cursor)
+            checked_at = time.monotonic()
+            # checksum mismatches in a row
+            mismatches = 0
+
+            while True:
+                select.select([connection], [], [], CATALOG_CHECK_INTERVAL)
+                _apply_notifications(connection, cursor)
+
+                if time.monotonic() - checked_at >= CATALOG_CHECK_INTERVAL:
+                    cursor.execute(
+                        'SELECT last_value FROM ' + VERSION_SEQUENCE
+                    )
+                    missing = snapshot.missed_changes(cursor.fetchone()[0])
+                    if missing is None:
+                        mismatches = 0
+                    elif _matches_committed(connection, cursor):
+                        # rolled back writes, or one still open
+                        snapshot.skip_to(missing)
+                        mismatches = 0
+                    elif mismatches:
+                        logger.warning('catalog missed changes, reloading')
+                        snapshot.load(cursor)
+                        mismatches = 0
+                    else:
+                        # a write may have committed between the query
+                        # and its notification, check again next interval
+                        mismatches = 1
+                    checked_at = time.monotonic()
+
+        except Exception:
+            logger.exception('catalog listener failed, reconnecting')
+            snapshot.ready = False
+            time.sleep(1)
+
+
+def init_catalog(app):
+    if not CATALOG_SNAPSHOT:
+        return
+
+    @app.before_first_request
+    def start_listener():
+        # started per worker, after gunicorn has forked
+        thread = threading.Thread(
+            target=listen, args=(db.get_engine(app),), daemon=True
+        )
+        thread.start()
+
+
+# Catalog reads: from the snapshot when it is loaded, else from the db
+
+def all_actors(name=None):
+    if serving():
+        return snapshot.all_actors(name)
+    return Actor.find(name)
+
+
+def get_actor(actor_id):
+    if serving():
+        return snapshot.get_actor(actor_id)
+    return Actor.get_one(actor_id)
+
+
+def get_actors(actor_ids):
+    if serving():
+        return snapshot.get_actors(actor_ids)
+    return Actor.get_many(actor_ids)
+
+
+def all_movies(title=None, released_after=None, released_before=None):
+    if serving():
+        return snapshot.all_movies(title, released_after, released_before)
+    return Movie.find(title, released_after, released_before)
+
+
+def get_movie(movie_id):
+    if serving():
+        return snapshot.get_movie(movie_id)
+    return Movie.get_one(movie_id)
+
+
+def get_movies(movie_ids):
+    if serving():
+        return snapshot.get_movies(movie_ids)
+    return Movie.get_many(movie_ids)
@@ -0,0 +1,133 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+import auth
+import catalog
+from models import db
+
+logger = logging.getLogger('app')
+
+# Health check settings (setup.sh)
+# probes within this many seconds reuse the last check results
+HEALTH_CACHE_SECONDS = float(os.environ.get('HEALTH_CACHE_SECONDS', 5))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 2))
+# how long a worker keeps serving, not ready, after SIGTERM; keep it
+# below gunicorn's --graceful-timeout
+DRAIN_SECONDS = float(os.environ.get('DRAIN_SECONDS', 10))
+
+draining = threading.Event()
+
+
+class CachedCheck:
+    # runs check() at most once per ttl seconds, failures are cached too
+    # so probes don't pile onto a dependency that is already down
+
+    def __init__(self, name, check, ttl=HEALTH_CACHE_SECONDS):
+        self.name = name
+        self.check = check
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.result = None
+        self.checked_at = None
+
+    def __call__(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.checked_at is None or now - self.checked_at >= self.ttl:
+                started = time.perf_counter()
+                try:
+                    self.check()
+                    ok = True
+                except Exception:
+                    # the probes are public: error details (hosts,
+                    # addresses) go to the log only
+                    logger.exception('health check %s failed', self.name)
+                    ok = False
+                self.result = {
+                    "ok": ok,
+                    "duration_ms": round(
+                        (time.perf_counter() - started) * 1000, 3
+                    )
+                }
+                self.checked_at = now
+
+            return dict(self.result)
+
+
+def check_database():
+    # on its own pooled connection, outside the request's session
+    with db.engine.connect() as connection:
+        connection.execute('SELECT 1')
+
+
+def check_jwks():
+    if not auth.get_jwks(timeout=HEALTH_CHECK_TIMEOUT).get('keys'):
+        raise ValueError('no signing keys')
+
+
+CHECKS = {
+    "database": CachedCheck("database", check_database),
+    "jwks": CachedCheck("jwks", check_jwks),
+}
+
+
+def run_checks():
+    return {name: check() for name, check in CHECKS.items()}
+
+
+def readiness():
+    # (ready, status, checks)
+    checks = run_checks()
+    if draining.is_set():
+        return False, "draining", checks
+    if catalog.CATALOG_SNAPSHOT and not catalog.snapshot.ready:
+        return False, "loading", checks
+    if not all(check["ok"] for check in checks.values()):
+        return False, "unavailable", checks
+    return True, "ready", checks
+
+
+_drain_installed = False
+
+
+def install_drain_handler():
+    # on SIGTERM, report not ready for DRAIN_SECONDS so the load balancer
+    # stops routing here, then hand over to the previous handler
+    # (gunicorn's graceful shutdown)
+    global _drain_installed
+    if _drain_installed:
+        return
+    if threading.current_thread() is not threading.main_thread():
+        return
+    _drain_installed = True
+    previous = signal.getsignal(signal.SIGTERM)
+
+    drained = threading.Event()
+
+    def drain(signum, frame):
+        if drained.is_set():
+            # back in the main thread once the drain period is over
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.kill(os.getpid(), signal.SIGTERM)
+            return
+        if draining.is_set():
+            return
+
+        draining.set()
+        logger.info('SIGTERM received, draining for %.1fs', DRAIN_SECONDS)
+
+        def drain_done():
+            drained.set()
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        timer = threading.Timer(DRAIN_SECONDS, drain_done)
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, drain)
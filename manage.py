@@ -2,7 +2,11 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, Stat
+import seed_data
+import query_bench
+import soak as soak_test
+import partitions
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +14,78 @@ manager = Manager(app)
 manager.add_command("db", MigrateCommand)
 
 
+@manager.command
+def rebuild_stats():
+    """Recompute the /stats counters from the actors and movies tables"""
+    Stat.rebuild()
+
+
+@manager.option('--actors', dest='actors', type=int, default=10000)
+@manager.option('--movies', dest='movies', type=int, default=10000)
+@manager.option('--seed', dest='seed', type=int, default=0)
+@manager.option('--truncate', dest='truncate', action='store_true',
+                help='empty the catalog tables first')
+@manager.option('--jobs', dest='jobs', type=int, default=1,
+                help='parallel COPY connections')
+@manager.option('--mean-age', dest='mean_age', type=float)
+@manager.option('--age-spread', dest='age_spread', type=float)
+@manager.option('--female-share', dest='female_share', type=float)
+@manager.option('--nonbinary-share', dest='nonbinary_share', type=float)
+@manager.option('--first-year', dest='first_year', type=int)
+@manager.option('--last-year', dest='last_year', type=int)
+@manager.option('--recent-bias', dest='recent_bias', type=float,
+                help='mean age of a movie in years')
+def seed(actors, movies, seed, truncate, jobs, **distribution):
+    """Bulk load generated actors and movies with COPY"""
+    seed_data.seed(actors, movies, seed, truncate, jobs, **distribution)
+
+
+@manager.option('--iterations', dest='iterations', type=int, default=2000)
+def bench_queries(iterations):
+    """Compare the CPU per call of the cached hot queries and plain ORM"""
+    query_bench.run(iterations)
+
+
+@manager.option('--through', dest='through', type=int,
+                help='create decade partitions up to this year')
+def movie_partitions(through):
+    """List the movies partitions, adding any missing up to --through"""
+    for name in partitions.create_partitions(through):
+        print('created', name)
+    partitions.report()
+
+
+@manager.option('--before', dest='before', type=int, required=True,
+                help='archive partitions that end by this year')
+@manager.option('--tablespace', dest='tablespace',
+                default=partitions.ARCHIVE_TABLESPACE)
+def archive_movies(before, tablespace):
+    """Move old movies partitions to the archive tablespace"""
+    for name in partitions.archive_partitions(before, tablespace):
+        print('archived', name)
+    partitions.report()
+
+
+@manager.option('--duration', dest='duration', type=float, default=3600,
+                help='seconds to run after the warmup')
+@manager.option('--interval', dest='interval', type=float, default=60,
+                help='seconds between samples')
+@manager.option('--warmup', dest='warmup', type=float, default=120)
+@manager.option('--threads', dest='threads', type=int, default=4)
+@manager.option('--seed', dest='seed', type=int, default=0)
+@manager.option('--token', dest='token',
+                help='send this token instead of skipping JWT checks')
+@manager.option('--max-rss-growth', dest='max_rss_growth', type=float,
+                default=50, help='MB')
+@manager.option('--max-object-growth', dest='max_object_growth',
+                type=float, default=20, help='percent')
+@manager.option('--max-latency-drift', dest='max_latency_drift',
+                type=float, default=1.5, help='ratio of the p95 latencies')
+def soak(**options):
+    """Run a mixed workload and fail on memory, pool or latency drift"""
+    if not soak_test.run(app, **options):
+        raise SystemExit(1)
+
+
 if __name__ == "__main__":
     manager.run()
@@ -1,6 +1,8 @@
 from __future__ import with_statement
 
 import logging
+import os
+import sys
 from logging.config import fileConfig
 
 from flask import current_app
@@ -16,6 +18,9 @@ config = context.config
 fileConfig(config.config_file_name)
 logger = logging.getLogger('alembic.env')
 
+# let revisions import the lock-safe helpers in migrations/online.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
 # add your model's MetaData object here
 # for 'autogenerate' support
 # from myapp import mymodel
@@ -0,0 +1,257 @@
+"""Lock-safe schema changes for large tables.
+
+Each helper runs outside the migration's transaction (in an alembic
+autocommit block) so that every step holds its locks only briefly:
+
+- DDL that needs an ACCESS EXCLUSIVE lock runs with a short lock_timeout
+  and is retried, instead of queueing behind a long query and blocking
+  every request that arrives after it.
+- Indexes are built with CREATE INDEX CONCURRENTLY.
+- Columns are added in phases: nullable column, default for new rows,
+  throttled batched backfill, then NOT NULL through a validated CHECK
+  constraint so the table is never scanned under an exclusive lock.
+- Rows are copied to a new table in throttled batches while a trigger
+  mirrors writes, and the tables are swapped in one short transaction.
+
+"""
+import logging
+import time
+
+from alembic import op
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger('alembic.online')
+
+LOCK_TIMEOUT_MS = 2000
+STATEMENT_TIMEOUT_MS = 0
+LOCK_ATTEMPTS = 10
+RETRY_DELAY = 1.0
+
+BATCH_SIZE = 5000
+# time slept after each batch, relative to how long the batch took
+THROTTLE = 1.0
+
+LOCK_NOT_AVAILABLE = '55P03'
+QUERY_CANCELED = '57014'
+# a batch that loses to a concurrent write is retried
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+BATCH_ATTEMPTS = 10
+
+
+def _set_timeouts(lock_timeout_ms, statement_timeout_ms):
+    op.execute("SET lock_timeout = '{:d}ms'".format(lock_timeout_ms))
+    op.execute(
+        "SET statement_timeout = '{:d}ms'".format(statement_timeout_ms)
+    )
+
+
+def with_lock_retry(statement, lock_timeout_ms=LOCK_TIMEOUT_MS,
+                    statement_timeout_ms=STATEMENT_TIMEOUT_MS,
+                    attempts=LOCK_ATTEMPTS, delay=RETRY_DELAY,
+                    transaction=False):
+    # statement is SQL text or a callable issuing op.* calls, run in
+    # autocommit mode with lock and statement timeouts; with transaction
+    # the callable's statements commit together or not at all
+    with op.get_context().autocommit_block():
+        _set_timeouts(lock_timeout_ms, statement_timeout_ms)
+        try:
+            for attempt in range(1, attempts + 1):
+                try:
+                    if transaction:
+                        op.execute('BEGIN')
+                    if callable(statement):
+                        result = statement()
+                    else:
+                        result = op.execute(statement)
+                    if transaction:
+                        op.execute('COMMIT')
+                    return result
+                except Exception as e:
+                    if transaction:
+                        op.execute('ROLLBACK')
+                    code = getattr(getattr(e, 'orig', None), 'pgcode', None)
+                    if (code not in (LOCK_NOT_AVAILABLE, QUERY_CANCELED,
+                                     DEADLOCK_DETECTED) or
+                            attempt == attempts):
+                        raise
+                    logger.warning(
+                        'lock not acquired (attempt %d/%d), retrying in '
+                        '%.1fs', attempt, attempts, delay * attempt
+                    )
+                    time.sleep(delay * attempt)
+        finally:
+            op.execute('RESET lock_timeout')
+            op.execute('RESET statement_timeout')
+
+
+def create_index_concurrently(index_name, table_name, columns, **kw):
+    def create():
+        # a failed concurrent build leaves an INVALID index behind
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(index_name))
+        op.create_index(
+            index_name, table_name, columns,
+            postgresql_concurrently=True, **kw
+        )
+
+    with_lock_retry(create)
+
+
+def drop_index_concurrently(index_name, table_name):
+    with_lock_retry(lambda: op.drop_index(
+        index_name, table_name=table_name, postgresql_concurrently=True
+    ))
+
+
+def in_batches(table_name, statement, label, batch_size=BATCH_SIZE,
+               throttle=THROTTLE):
+    # run statement (SQL binding :last and :upper) over table_name's ids
+    # in ranges of batch_size rows, one short transaction per batch,
+    # sleeping between batches to leave room for traffic
+    connection = op.get_bind()
+    with op.get_context().autocommit_block():
+        max_id = connection.execute(
+            text('SELECT max(id) FROM {}'.format(table_name))
+        ).scalar() or 0
+        last_id = 0
+        done = 0
+        while last_id < max_id:
+            started = time.monotonic()
+            upper = connection.execute(text(
+                'SELECT max(id) FROM (SELECT id FROM {} WHERE id > :last '
+                'ORDER BY id LIMIT :size) AS batch'.format(table_name)
+            ), last=last_id, size=batch_size).scalar()
+            if upper is None:
+                break
+
+            for attempt in range(1, BATCH_ATTEMPTS + 1):
+                try:
+                    result = connection.execute(
+                        text(statement), last=last_id, upper=upper
+                    )
+                    break
+                except DBAPIError as e:
+                    code = getattr(e.orig, 'pgcode', None)
+                    if (code not in (SERIALIZATION_FAILURE,
+                                     DEADLOCK_DETECTED) or
+                            attempt == BATCH_ATTEMPTS):
+                        raise
+                    logger.warning('%s: batch retried after %s', label, code)
+                    time.sleep(RETRY_DELAY * attempt / 10)
+            done += result.rowcount
+            last_id = upper
+
+            elapsed = time.monotonic() - started
+            logger.info(
+                '%s: %d rows, %.0f%% done',
+                label, done, 100.0 * min(last_id, max_id) / max_id
+            )
+            time.sleep(elapsed * throttle)
+
+
+def backfill(table_name, column_name, value_sql, batch_size=BATCH_SIZE,
+             throttle=THROTTLE):
+    # UPDATE the NULL rows in primary key order
+    in_batches(
+        table_name,
+        'UPDATE {table} SET {column} = {value} WHERE id > :last '
+        'AND id <= :upper AND {column} IS NULL'.format(
+            table=table_name, column=column_name, value=value_sql
+        ),
+        'backfill {}.{}'.format(table_name, column_name),
+        batch_size, throttle
+    )
+
+
+def copy_table(source, target, columns, swap, batch_size=BATCH_SIZE,
+               throttle=THROTTLE):
+    # fill the empty table target with source's rows while source stays
+    # writable, then run swap() in one transaction under lock retries.
+    # A trigger mirrors every write on source to target by id; each batch
+    # locks its source rows (FOR SHARE) so a concurrent write either
+    # lands first and is copied as it is now, or waits for the batch and
+    # is mirrored after it. swap() has to drop source, which drops the
+    # trigger with it. An interrupted copy can be run again.
+    function = '{}_mirror_to_{}'.format(source, target)
+    column_list = ', '.join(columns)
+    with_lock_retry("""
+        CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {target} WHERE id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {target} ({columns})
+                VALUES ({new_columns});
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """.format(
+        function=function, target=target, columns=column_list,
+        new_columns=', '.join('NEW.' + column for column in columns)
+    ))
+    with_lock_retry(lambda: [op.execute(statement) for statement in (
+        'DROP TRIGGER IF EXISTS {} ON {}'.format(function, source),
+        """
+        CREATE TRIGGER {function} AFTER INSERT OR UPDATE OR DELETE
+        ON {source} FOR EACH ROW EXECUTE PROCEDURE {function}()
+        """.format(function=function, source=source)
+    )], transaction=True)
+
+    in_batches(
+        source,
+        'INSERT INTO {target} ({columns}) SELECT {columns} FROM {source} '
+        'WHERE id > :last AND id <= :upper FOR SHARE '
+        'ON CONFLICT DO NOTHING'.format(
+            target=target, columns=column_list, source=source
+        ),
+        'copy {} to {}'.format(source, target),
+        batch_size, throttle
+    )
+
+    def swap_tables():
+        op.execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(source))
+        swap()
+        op.execute('DROP FUNCTION {}()'.format(function))
+
+    with_lock_retry(swap_tables, transaction=True)
+
+
+def add_column_phased(table_name, column, value_sql,
+                      batch_size=BATCH_SIZE, throttle=THROTTLE):
+    # column is an sa.Column; its server_default applies to new rows and
+    # value_sql fills the existing ones
+    nullable = column.nullable
+    server_default = column.server_default
+    column.nullable = True
+    column.server_default = None
+
+    with_lock_retry(lambda: op.add_column(table_name, column))
+    if server_default is not None:
+        with_lock_retry(lambda: op.alter_column(
+            table_name, column.name, server_default=server_default.arg
+        ))
+
+    backfill(table_name, column.name, value_sql, batch_size, throttle)
+
+    if not nullable:
+        set_not_null(table_name, column.name)
+
+
+def set_not_null(table_name, column_name):
+    # SET NOT NULL skips its full-table scan when a validated CHECK
+    # constraint already proves it, and VALIDATE doesn't block writes
+    constraint = '{}_{}_not_null'.format(table_name, column_name)
+    with_lock_retry(
+        'ALTER TABLE {} ADD CONSTRAINT {} CHECK ({} IS NOT NULL) '
+        'NOT VALID'.format(table_name, constraint, column_name)
+    )
+    with_lock_retry(
+        'ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(table_name, constraint)
+    )
+    with_lock_retry(lambda: op.alter_column(
+        table_name, column_name, nullable=False
+    ))
+    with_lock_retry(lambda: op.drop_constraint(constraint, table_name))
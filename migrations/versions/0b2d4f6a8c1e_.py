@@ -0,0 +1,31 @@
+"""index actor names and movie release dates
+
+Revision ID: 0b2d4f6a8c1e
+Revises: f1a3b5c7d9e2
+Create Date: 2026-10-19 18:07:45.281093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '0b2d4f6a8c1e'
+down_revision = 'f1a3b5c7d9e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # back the /actors?name= and /movies release date filters
+    create_index_concurrently('ix_actors_name', 'actors', ['name'])
+    create_index_concurrently(
+        'ix_movies_release_date', 'movies', ['release_date']
+    )
+
+
+def downgrade():
+    drop_index_concurrently('ix_movies_release_date', 'movies')
+    drop_index_concurrently('ix_actors_name', 'actors')
@@ -0,0 +1,177 @@
+"""partition movies by release date
+
+Revision ID: 7d9f1b3c5e6a
+Revises: 0b2d4f6a8c1e
+Create Date: 2026-10-19 20:12:37.508126
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+from online import copy_table
+
+
+# revision identifiers, used by Alembic.
+revision = '7d9f1b3c5e6a'
+down_revision = '0b2d4f6a8c1e'
+branch_labels = None
+depends_on = None
+
+# one partition per decade from FIRST_YEAR, everything older shares one;
+# later decades are added with `python manage.py movie_partitions`
+FIRST_YEAR = 1900
+PARTITION_YEARS = 10
+# decades created ahead of the latest release date
+AHEAD_YEARS = 20
+
+COLUMNS = ['id', 'title', 'release_date', 'version']
+
+NOTIFY_FUNCTION = """
+    CREATE OR REPLACE FUNCTION notify_catalog_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('catalog_changes', json_build_object(
+            'version', nextval('catalog_version_seq'),
+            'table', {table},
+            'op', lower(TG_OP),
+            'id', CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END,
+            'row', CASE WHEN TG_OP = 'DELETE' THEN NULL
+                        ELSE row_to_json(NEW) END
+        )::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def replace_movies(table, *statements):
+    # the swap at the end of copy_table(): table, filled and kept in sync
+    # by then, becomes movies
+    op.execute('ALTER SEQUENCE movies_id_seq OWNED BY {}.id'.format(table))
+    op.execute('DROP TABLE movies')
+    op.execute('ALTER TABLE {} RENAME TO movies'.format(table))
+    op.execute(
+        'ALTER TABLE movies RENAME CONSTRAINT {}_pkey TO movies_pkey'
+        .format(table)
+    )
+    op.execute(
+        'ALTER INDEX ix_{}_release_date RENAME TO ix_movies_release_date'
+        .format(table)
+    )
+    for statement in statements:
+        op.execute(statement)
+
+
+def upgrade():
+    # left behind by an interrupted run, movies itself is untouched
+    # until the swap
+    op.execute('DROP TABLE IF EXISTS movies_partitioned, movie_titles')
+    op.execute('DROP FUNCTION IF EXISTS maintain_movie_titles()')
+
+    # the partition key has to be part of the primary key, titles are
+    # kept unique through movie_titles instead
+    op.execute("""
+        CREATE TABLE movies_partitioned (
+            id integer NOT NULL DEFAULT nextval('movies_id_seq'),
+            title varchar NOT NULL,
+            release_date timestamp without time zone NOT NULL,
+            version integer NOT NULL DEFAULT 1,
+            PRIMARY KEY (id, release_date)
+        ) PARTITION BY RANGE (release_date)
+    """)
+    op.execute("""
+        CREATE TABLE movies_before_{0} PARTITION OF movies_partitioned
+        FOR VALUES FROM (MINVALUE) TO ('{0}-01-01')
+    """.format(FIRST_YEAR))
+
+    latest = op.get_bind().execute(
+        sa.text('SELECT max(release_date) FROM movies')
+    ).scalar()
+    last_year = max(date.today().year, latest.year if latest else 0)
+    for year in range(FIRST_YEAR, last_year + AHEAD_YEARS, PARTITION_YEARS):
+        op.execute("""
+            CREATE TABLE movies_y{0} PARTITION OF movies_partitioned
+            FOR VALUES FROM ('{0}-01-01') TO ('{1}-01-01')
+        """.format(year, year + PARTITION_YEARS))
+    op.create_index(
+        'ix_movies_partitioned_release_date', 'movies_partitioned',
+        ['release_date']
+    )
+
+    # one row per movie: unique titles and ids across all partitions,
+    # and the partition (release date) to look a movie up in
+    op.create_table(
+        'movie_titles',
+        sa.Column('title', sa.String(), primary_key=True),
+        sa.Column('movie_id', sa.Integer(), nullable=False, unique=True),
+        sa.Column('release_date', sa.DateTime(), nullable=False)
+    )
+    # a movie moving partition is a DELETE followed by an INSERT
+    op.execute("""
+        CREATE FUNCTION maintain_movie_titles() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM movie_titles WHERE movie_id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO movie_titles (title, movie_id, release_date)
+                VALUES (NEW.title, NEW.id, NEW.release_date);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    # on the new table from the start, so the copy fills movie_titles too
+    op.execute("""
+        CREATE TRIGGER movies_maintain_titles
+        AFTER INSERT OR DELETE OR UPDATE OF id, title, release_date
+        ON movies_partitioned
+        FOR EACH ROW EXECUTE PROCEDURE maintain_movie_titles()
+    """)
+
+    # movies stays readable and writable during the throttled copy, only
+    # the swap takes an ACCESS EXCLUSIVE lock
+    copy_table('movies', 'movies_partitioned', COLUMNS, lambda: replace_movies(
+        'movies_partitioned',
+        # triggers on a partition see its own name in TG_TABLE_NAME
+        NOTIFY_FUNCTION.format(table='coalesce(TG_ARGV[0], TG_TABLE_NAME)'),
+        """
+        CREATE TRIGGER movies_notify_catalog_change
+        AFTER INSERT OR UPDATE OR DELETE ON movies
+        FOR EACH ROW EXECUTE PROCEDURE notify_catalog_change('movies')
+        """
+    ))
+
+
+def downgrade():
+    op.execute('DROP TABLE IF EXISTS movies_unpartitioned')
+    op.execute("""
+        CREATE TABLE movies_unpartitioned (
+            id integer NOT NULL DEFAULT nextval('movies_id_seq'),
+            title varchar NOT NULL,
+            release_date timestamp without time zone NOT NULL,
+            version integer NOT NULL DEFAULT 1,
+            PRIMARY KEY (id),
+            CONSTRAINT movies_title_key UNIQUE (title)
+        )
+    """)
+    op.create_index(
+        'ix_movies_unpartitioned_release_date', 'movies_unpartitioned',
+        ['release_date']
+    )
+
+    copy_table(
+        'movies', 'movies_unpartitioned', COLUMNS,
+        lambda: replace_movies(
+            'movies_unpartitioned',
+            'DROP TABLE movie_titles',
+            'DROP FUNCTION maintain_movie_titles()',
+            NOTIFY_FUNCTION.format(table='TG_TABLE_NAME'),
+            """
+            CREATE TRIGGER movies_notify_catalog_change
+            AFTER INSERT OR UPDATE OR DELETE ON movies
+            FOR EACH ROW EXECUTE PROCEDURE notify_catalog_change()
+            """
+        )
+    )
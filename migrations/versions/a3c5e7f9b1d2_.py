@@ -0,0 +1,48 @@
+"""add stats table
+
+Revision ID: a3c5e7f9b1d2
+Revises: 5b7d7614e3e9
+Create Date: 2026-10-19 09:12:04.118420
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c5e7f9b1d2'
+down_revision = '5b7d7614e3e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stats',
+    sa.Column('metric', sa.String(), nullable=False),
+    sa.Column('bucket', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('metric', 'bucket')
+    )
+
+    # seed the counters from the rows that already exist
+    op.execute("""
+        INSERT INTO stats (metric, bucket, count)
+        SELECT 'actors', 'total', count(*) FROM actors
+        UNION ALL
+        SELECT 'actors.by_gender', gender, count(*)
+        FROM actors GROUP BY gender
+        UNION ALL
+        SELECT 'actors.by_age',
+               (age / 10 * 10) || '-' || (age / 10 * 10 + 9), count(*)
+        FROM actors GROUP BY age / 10
+        UNION ALL
+        SELECT 'movies', 'total', count(*) FROM movies
+        UNION ALL
+        SELECT 'movies.by_release_year',
+               extract(year FROM release_date)::int::text, count(*)
+        FROM movies GROUP BY extract(year FROM release_date)
+    """)
+
+
+def downgrade():
+    op.drop_table('stats')
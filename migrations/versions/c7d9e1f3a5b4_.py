@@ -0,0 +1,32 @@
+"""add version columns
+
+Revision ID: c7d9e1f3a5b4
+Revises: a3c5e7f9b1d2
+Create Date: 2026-10-19 11:40:27.532816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online import add_column_phased
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d9e1f3a5b4'
+down_revision = 'a3c5e7f9b1d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    add_column_phased('actors', sa.Column(
+        'version', sa.Integer(), nullable=False, server_default='1'
+    ), '1')
+    add_column_phased('movies', sa.Column(
+        'version', sa.Integer(), nullable=False, server_default='1'
+    ), '1')
+
+
+def downgrade():
+    op.drop_column('movies', 'version')
+    op.drop_column('actors', 'version')
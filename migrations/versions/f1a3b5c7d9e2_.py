@@ -0,0 +1,54 @@
+"""notify catalog changes
+
+Revision ID: f1a3b5c7d9e2
+Revises: e2f4a6b8c0d1
+Create Date: 2026-10-19 16:25:13.660384
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a3b5c7d9e2'
+down_revision = 'e2f4a6b8c0d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # every change to actors or movies gets the next catalog version and
+    # is published, row included, to the workers' in-memory snapshots
+    op.execute('CREATE SEQUENCE catalog_version_seq')
+    op.execute("""
+        CREATE FUNCTION notify_catalog_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('catalog_changes', json_build_object(
+                'version', nextval('catalog_version_seq'),
+                'table', TG_TABLE_NAME,
+                'op', lower(TG_OP),
+                'id', CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END,
+                'row', CASE WHEN TG_OP = 'DELETE' THEN NULL
+                            ELSE row_to_json(NEW) END
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER actors_notify_catalog_change
+        AFTER INSERT OR UPDATE OR DELETE ON actors
+        FOR EACH ROW EXECUTE PROCEDURE notify_catalog_change()
+    """)
+    op.execute("""
+        CREATE TRIGGER movies_notify_catalog_change
+        AFTER INSERT OR UPDATE OR DELETE ON movies
+        FOR EACH ROW EXECUTE PROCEDURE notify_catalog_change()
+    """)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER movies_notify_catalog_change ON movies')
+    op.execute('DROP TRIGGER actors_notify_catalog_change ON actors')
+    op.execute('DROP FUNCTION notify_catalog_change()')
+    op.execute('DROP SEQUENCE catalog_version_seq')
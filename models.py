@@ -1,5 +1,13 @@
+import json
+from collections import Counter
+from flask import json as flask_json
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import (Column, Integer, BigInteger, String, DateTime, JSON,
+                        func, extract, inspect, select, bindparam)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext import baked
+from sqlalchemy.util import LRUCache
+from dateutil import parser as date_parser
 import os
 
 database_path = os.environ["DATABASE_URL"]
@@ -17,13 +25,410 @@ def rollback():
     db.session.rollback()
 
 
+# Query caching: ORM reads are baked queries and Core writes are built
+# once with bind parameters, so neither is rebuilt or recompiled per
+# request
+
+class CountingCache(LRUCache):
+    # compiled_cache that counts its lookups
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        if value is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+
+bakery = baked.bakery(size=200)
+compiled_cache = CountingCache(200)
+_statements = {}
+_baked_stats = {}
+
+
+def baked_query(name, build):
+    # build(session) only runs when the query is not in the bakery yet
+    stats = _baked_stats.setdefault(name, {"calls": 0, "misses": 0})
+    stats["calls"] += 1
+
+    def counted(session):
+        stats["misses"] += 1
+        return build(session)
+
+    return bakery(counted, name)
+
+
+def _prebuilt(key, build):
+    statement = _statements.get(key)
+    if statement is None:
+        statement = _statements[key] = build()
+    return statement
+
+
+def _execute(statement, params):
+    # on the session's connection, inside its transaction
+    connection = db.session.connection().execution_options(
+        compiled_cache=compiled_cache
+    )
+    return connection.execute(statement, params)
+
+
+def query_cache_stats():
+    return {
+        "baked": {
+            name: dict(stats) for name, stats in sorted(_baked_stats.items())
+        },
+        "compiled": {
+            "hits": compiled_cache.hits,
+            "misses": compiled_cache.misses,
+            "size": len(compiled_cache)
+        }
+    }
+
+
+# Stats helpers
+
+def _age_bucket(age):
+    low = int(age) // 10 * 10
+    return "{}-{}".format(low, low + 9)
+
+
+def _as_datetime(release_date):
+    # release_date arrives as the raw request string
+    if isinstance(release_date, str):
+        return date_parser.parse(release_date)
+    return release_date
+
+
+def _release_year(release_date):
+    return str(_as_datetime(release_date).year)
+
+
+class VersionConflict(Exception):
+    # raised when an If-Match version no longer matches the row
+    def __init__(self, current_version):
+        self.current_version = current_version
+
+
+def _row_condition(table, partition_column=None):
+    # id = :row_id, and on movies release_date = the movie's, read from
+    # movie_titles in the same statement: Postgres runs that subquery
+    # first and only scans the movie's partition
+    condition = table.c.id == bindparam("row_id")
+    if partition_column is not None:
+        condition &= (
+            table.c[partition_column] == MovieTitle.release_date_of_row()
+        )
+    return condition
+
+
+def _missing_or_conflict(table, params, expected_version,
+                         partition_column=None):
+    # no row matched: tell a missing row apart from a stale If-Match
+    if expected_version is None:
+        return
+    statement = _prebuilt(
+        ("version", table.name, partition_column),
+        lambda: select([table.c.version]).where(
+            _row_condition(table, partition_column)
+        )
+    )
+    current_version = _execute(statement, params).scalar()
+    if current_version is not None:
+        raise VersionConflict(current_version)
+
+
+def _locked(table, partition_column, *columns):
+    # current values of a row, locked until the end of the transaction
+    return select([table.c.id] + [table.c[c] for c in columns]).where(
+        _row_condition(table, partition_column)
+    ).with_for_update().alias("old")
+
+
+def _update_returning(table, columns, versioned, old_columns,
+                      partition_column=None):
+    # UPDATE ... RETURNING the new row and the old values of old_columns,
+    # binds row_id, expected_version and value_<column>
+    def build():
+        old = _locked(table, partition_column, *old_columns)
+        condition = table.c.id == old.c.id
+        if partition_column is not None:
+            condition &= (
+                table.c[partition_column] == MovieTitle.release_date_of_row()
+            )
+        if versioned:
+            condition &= table.c.version == bindparam("expected_version")
+        return table.update().where(condition).values(
+            version=table.c.version + 1,
+            **{
+                column: bindparam(
+                    "value_" + column, type_=table.c[column].type
+                )
+                for column in columns
+            }
+        ).returning(
+            *table.c, *[old.c[c].label("old_" + c) for c in old_columns]
+        )
+
+    return _prebuilt(
+        ("update", table.name, columns, versioned, partition_column), build
+    )
+
+
+def _delete_returning(table, versioned, partition_column=None):
+    def build():
+        condition = _row_condition(table, partition_column)
+        if versioned:
+            condition &= table.c.version == bindparam("expected_version")
+        return table.delete().where(condition).returning(*table.c)
+
+    return _prebuilt(
+        ("delete", table.name, versioned, partition_column), build
+    )
+
+
+def _row_params(row_id, expected_version, values=()):
+    params = {"row_id": row_id}
+    if expected_version is not None:
+        params["expected_version"] = expected_version
+    for column, value in dict(values).items():
+        params["value_" + column] = value
+    return params
+
+
+def _previous(obj, key):
+    # value of an attribute as it was loaded from the database
+    history = inspect(obj).attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, key)
+
+
+class Stat(db.Model):
+    # one counter per (metric, bucket), kept up to date by the model hooks
+    __tablename__ = "stats"
+
+    metric = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    # every insert and delete updates the one ("actors", "total") or
+    # ("movies", "total") row, so writers to a table wait on each other
+    # for that row lock until they commit; writers take the change log's
+    # advisory lock before it and are serialized already (see
+    # Change.LOCK_ID), so sharding the counters would not buy throughput
+
+    @classmethod
+    def bump(cls, deltas):
+        # rows in key order: concurrent upserts lock them in the same
+        # order and cannot deadlock (male -> female against female -> male)
+        rows = [
+            {"metric": metric, "bucket": bucket, "count": count}
+            for (metric, bucket), count in sorted(deltas.items()) if count
+        ]
+        if not rows:
+            return
+
+        params = {}
+        for i, row in enumerate(rows):
+            for key, value in row.items():
+                params["{}_{}".format(key, i)] = value
+        statement = _prebuilt(
+            ("stats.bump", len(rows)), lambda: cls._bump_statement(len(rows))
+        )
+        _execute(statement, params)
+
+    @classmethod
+    def _bump_statement(cls, size):
+        # upsert of size rows, binds metric_<i>, bucket_<i> and count_<i>
+        stmt = pg_insert(cls.__table__).values([
+            {
+                key: bindparam("{}_{}".format(key, i))
+                for key in ("metric", "bucket", "count")
+            }
+            for i in range(size)
+        ])
+        return stmt.on_conflict_do_update(
+            index_elements=["metric", "bucket"],
+            set_={"count": cls.__table__.c.count + stmt.excluded.count}
+        )
+
+    @classmethod
+    def summary(cls):
+        summary = {
+            "actors": {"total": 0, "by_gender": {}, "by_age": {}},
+            "movies": {"total": 0, "by_release_year": {}}
+        }
+        query = baked_query(
+            "stats.summary", lambda s: s.query(cls).filter(cls.count > 0)
+        )
+        for stat in query(db.session()).all():
+            group, _, field = stat.metric.partition(".")
+            if field:
+                summary[group][field][stat.bucket] = stat.count
+            else:
+                summary[group]["total"] = stat.count
+        return summary
+
+    @classmethod
+    def rebuild(cls):
+        # blocks writes until the counters are replaced, so none lands
+        # between the counts and the DELETE; writers lock their row before
+        # any counter, as this does
+        db.session.execute("LOCK TABLE actors, movies IN SHARE MODE")
+        deltas = Counter()
+
+        age_bucket = Actor.age / 10 * 10
+        for gender, count in db.session.query(
+                Actor.gender, func.count()).group_by(Actor.gender):
+            deltas[("actors", "total")] += count
+            deltas[("actors.by_gender", gender)] += count
+        for low, count in db.session.query(
+                age_bucket, func.count()).group_by(age_bucket):
+            deltas[("actors.by_age", _age_bucket(low))] += count
+
+        year = extract("year", Movie.release_date)
+        for release_year, count in db.session.query(
+                year, func.count()).group_by(year):
+            deltas[("movies", "total")] += count
+            deltas[("movies.by_release_year", str(int(release_year)))] += count
+
+        cls.query.delete()
+        cls.bump(deltas)
+        db.session.commit()
+
+
+class Change(db.Model):
+    # append-only log of every write made through the models, read by
+    # /changes so clients can sync incrementally
+    __tablename__ = "changes"
+
+    # writers hold this advisory lock until commit, so change ids become
+    # visible in order and a cursor never skips a change that commits
+    # late. It is one lock for the whole database: writes commit one at
+    # a time, which caps write throughput at one commit round trip each,
+    # and an atomic /batch holds it until the batch commits. Every write
+    # takes it first (Change.lock()), before any row or stats counter: a
+    # writer already holding a counter while waiting for it would
+    # deadlock with a batch that holds it and goes on to that counter
+    LOCK_ID = 3003
+
+    id = Column(BigInteger, primary_key=True)
+    table_name = Column(String, nullable=False)
+    operation = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    data = Column(JSON)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    @classmethod
+    def lock(cls):
+        statement = _prebuilt(("advisory_lock",), lambda: select(
+            [func.pg_advisory_xact_lock(bindparam("lock_id"))]
+        ))
+        _execute(statement, {"lock_id": cls.LOCK_ID})
+
+    @classmethod
+    def record(cls, table_name, operation, row):
+        # the caller took Change.lock() before writing row
+        db.session.add(cls(
+            table_name=table_name,
+            operation=operation,
+            row_id=row.id,
+            # stored the way the API renders it, e.g. http dates
+            data=json.loads(flask_json.dumps(row.format()))
+        ))
+
+    @classmethod
+    def since(cls, cursor, limit, tables):
+        query = baked_query("changes.since", lambda s: s.query(cls).filter(
+            cls.id > bindparam("cursor"),
+            cls.table_name.in_(bindparam("tables", expanding=True))
+        ).order_by(cls.id).limit(bindparam("limit")))
+        return query(db.session()).params(
+            cursor=cursor, tables=list(tables), limit=limit
+        ).all()
+
+    def format(self):
+        return {
+            "id": self.id,
+            "table": self.table_name,
+            "operation": self.operation,
+            "row_id": self.row_id,
+            "data": self.data,
+            "created_at": self.created_at
+        }
+
+
 class Movie(db.Model):
     __tablename__ = "public.actors"
     __tablename__ = "movies"
 
-    id = Column(Integer, primary_key=True)
-    title = Column(String, unique=True, nullable=False)
-    release_date = Column(DateTime, nullable=False)
+    # partitioned by release date, which makes it part of the primary
+    # key; rows are still identified by id alone, and titles are kept
+    # unique through movie_titles
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    title = Column(String, nullable=False)
+    release_date = Column(DateTime, primary_key=True, index=True)
+    version = Column(Integer, nullable=False)
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (release_date)"}
+    __mapper_args__ = {"version_id_col": version, "primary_key": [id]}
+
+    @staticmethod
+    def stat_keys(release_date):
+        return [
+            ("movies", "total"),
+            ("movies.by_release_year", _release_year(release_date))
+        ]
+
+    # Lookups by id or title compare release_date with the movie's, read
+    # from movie_titles within the same statement, so only that movie's
+    # partition is scanned
+
+    @classmethod
+    def get_one(cls, movie_id):
+        # filtered rather than Query.get(), whose baked form rebuilds
+        # the base query on every call
+        query = baked_query("movies.get", lambda s: s.query(cls).filter(
+            cls.id == bindparam("row_id"),
+            cls.release_date == MovieTitle.release_date_of_row()
+        ))
+        return query(db.session()).params(row_id=movie_id).one_or_none()
+
+    @classmethod
+    def get_many(cls, movie_ids):
+        # probes the (id, release_date) primary key of each partition
+        query = baked_query("movies.get_many", lambda s: s.query(cls).filter(
+            cls.id.in_(bindparam("ids", expanding=True))
+        ))
+        return query(db.session()).params(ids=list(movie_ids)).all()
+
+    @classmethod
+    def find(cls, title=None, released_after=None, released_before=None):
+        query = baked_query("movies.find", lambda s: s.query(cls))
+        if title is not None:
+            query += lambda q: q.filter(
+                cls.title == bindparam("title"),
+                cls.release_date == MovieTitle.release_date_of_title()
+            )
+        if released_after is not None:
+            query += lambda q: q.filter(
+                cls.release_date >= bindparam("released_after")
+            )
+        if released_before is not None:
+            query += lambda q: q.filter(
+                cls.release_date <= bindparam("released_before")
+            )
+        return query(db.session()).params(
+            title=title,
+            released_after=released_after,
+            released_before=released_before
+        ).all()
 
     def format(self):
         return {
@@ -33,15 +438,114 @@ class Movie(db.Model):
             }
 
     def insert(self):
+        self.release_date = _as_datetime(self.release_date)
+        Change.lock()
         db.session.add(self)
+        db.session.flush()
+        Stat.bump(Counter(self.stat_keys(self.release_date)))
+        Change.record(self.__tablename__, "insert", self)
         db.session.commit()
 
     def update(self):
+        self.release_date = _as_datetime(self.release_date)
+        Change.lock()
+        # the row before the counters, the order Stat.rebuild() locks in
+        db.session.flush()
+        deltas = Counter(self.stat_keys(self.release_date))
+        deltas.subtract(self.stat_keys(_previous(self, "release_date")))
+        Stat.bump(deltas)
+        Change.record(self.__tablename__, "update", self)
         db.session.commit()
 
     def delete(self):
+        Change.lock()
         db.session.delete(self)
+        db.session.flush()
+        deltas = Counter()
+        deltas.subtract(self.stat_keys(self.release_date))
+        Stat.bump(deltas)
+        Change.record(self.__tablename__, "delete", self)
+        db.session.commit()
+
+    @classmethod
+    def update_by_id(cls, movie_id, expected_version=None, **values):
+        # one UPDATE ... RETURNING instead of load, modify and refresh
+        table = cls.__table__
+        statement = _update_returning(
+            table, tuple(sorted(values)), expected_version is not None,
+            ("release_date",), "release_date"
+        )
+        Change.lock()
+        row = _execute(
+            statement, _row_params(movie_id, expected_version, values)
+        ).first()
+        if row is None:
+            _missing_or_conflict(
+                table, _row_params(movie_id, None), expected_version,
+                "release_date"
+            )
+            return None
+
+        deltas = Counter(cls.stat_keys(row.release_date))
+        deltas.subtract(cls.stat_keys(row.old_release_date))
+        Stat.bump(deltas)
+        result = cls(**{column.name: row[column] for column in table.c})
+        Change.record(table.name, "update", result)
+        db.session.commit()
+        return result
+
+    @classmethod
+    def delete_by_id(cls, movie_id, expected_version=None):
+        table = cls.__table__
+        statement = _delete_returning(
+            table, expected_version is not None, "release_date"
+        )
+        Change.lock()
+        row = _execute(
+            statement, _row_params(movie_id, expected_version)
+        ).first()
+        if row is None:
+            _missing_or_conflict(
+                table, _row_params(movie_id, None), expected_version,
+                "release_date"
+            )
+            return None
+
+        deltas = Counter()
+        deltas.subtract(cls.stat_keys(row.release_date))
+        Stat.bump(deltas)
+        result = cls(**{column.name: row[column] for column in table.c})
+        Change.record(table.name, "delete", result)
         db.session.commit()
+        return result
+
+
+class MovieTitle(db.Model):
+    # one row per movie, kept up to date by a trigger on movies: makes
+    # titles unique across the partitions and tells which partition a
+    # movie is in
+    __tablename__ = "movie_titles"
+
+    title = Column(String, primary_key=True)
+    movie_id = Column(Integer, nullable=False, unique=True)
+    release_date = Column(DateTime, nullable=False)
+
+    # release dates as subqueries, for lookups on movies: uncorrelated,
+    # so they run once before the scan and prune it to one partition
+
+    @classmethod
+    def release_date_of_row(cls):
+        # of the movie bound as row_id
+        return select([cls.release_date]).where(
+            cls.movie_id == bindparam("row_id")
+        ).as_scalar()
+
+    @classmethod
+    def release_date_of_title(cls):
+        # of the movie bound as title
+        return select([cls.release_date]).where(
+            cls.title == bindparam("title")
+        ).as_scalar()
 
 
 class Actor(db.Model):
@@ -49,9 +553,43 @@ class Actor(db.Model):
     __tablename__ = "actors"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, index=True)
     age = Column(Integer, nullable=False)
     gender = Column(String, nullable=False)
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    @staticmethod
+    def stat_keys(gender, age):
+        return [
+            ("actors", "total"),
+            ("actors.by_gender", gender),
+            ("actors.by_age", _age_bucket(age))
+        ]
+
+    @classmethod
+    def get_one(cls, actor_id):
+        # filtered rather than Query.get(), whose baked form rebuilds
+        # the base query on every call
+        query = baked_query("actors.get", lambda s: s.query(cls).filter(
+            cls.id == bindparam("id")
+        ))
+        return query(db.session()).params(id=actor_id).one_or_none()
+
+    @classmethod
+    def get_many(cls, actor_ids):
+        query = baked_query("actors.get_many", lambda s: s.query(cls).filter(
+            cls.id.in_(bindparam("ids", expanding=True))
+        ))
+        return query(db.session()).params(ids=list(actor_ids)).all()
+
+    @classmethod
+    def find(cls, name=None):
+        query = baked_query("actors.find", lambda s: s.query(cls))
+        if name is not None:
+            query += lambda q: q.filter(cls.name == bindparam("name"))
+        return query(db.session()).params(name=name).all()
 
     def format(self):
         return {
@@ -62,12 +600,79 @@ class Actor(db.Model):
         }
 
     def insert(self):
+        Change.lock()
         db.session.add(self)
+        db.session.flush()
+        Stat.bump(Counter(self.stat_keys(self.gender, self.age)))
+        Change.record(self.__tablename__, "insert", self)
         db.session.commit()
 
     def update(self):
+        Change.lock()
+        # the row before the counters, the order Stat.rebuild() locks in
+        db.session.flush()
+        deltas = Counter(self.stat_keys(self.gender, self.age))
+        deltas.subtract(self.stat_keys(
+            _previous(self, "gender"), _previous(self, "age")
+        ))
+        Stat.bump(deltas)
+        Change.record(self.__tablename__, "update", self)
         db.session.commit()
 
     def delete(self):
+        Change.lock()
         db.session.delete(self)
+        db.session.flush()
+        deltas = Counter()
+        deltas.subtract(self.stat_keys(self.gender, self.age))
+        Stat.bump(deltas)
+        Change.record(self.__tablename__, "delete", self)
+        db.session.commit()
+
+    @classmethod
+    def update_by_id(cls, actor_id, expected_version=None, **values):
+        # one UPDATE ... RETURNING instead of load, modify and refresh
+        table = cls.__table__
+        statement = _update_returning(
+            table, tuple(sorted(values)), expected_version is not None,
+            ("gender", "age")
+        )
+        Change.lock()
+        row = _execute(
+            statement, _row_params(actor_id, expected_version, values)
+        ).first()
+        if row is None:
+            _missing_or_conflict(
+                table, _row_params(actor_id, None), expected_version
+            )
+            return None
+
+        deltas = Counter(cls.stat_keys(row.gender, row.age))
+        deltas.subtract(cls.stat_keys(row.old_gender, row.old_age))
+        Stat.bump(deltas)
+        result = cls(**{column.name: row[column] for column in table.c})
+        Change.record(table.name, "update", result)
+        db.session.commit()
+        return result
+
+    @classmethod
+    def delete_by_id(cls, actor_id, expected_version=None):
+        table = cls.__table__
+        statement = _delete_returning(table, expected_version is not None)
+        Change.lock()
+        row = _execute(
+            statement, _row_params(actor_id, expected_version)
+        ).first()
+        if row is None:
+            _missing_or_conflict(
+                table, _row_params(actor_id, None), expected_version
+            )
+            return None
+
+        deltas = Counter()
+        deltas.subtract(cls.stat_keys(row.gender, row.age))
+        Stat.bump(deltas)
+        result = cls(**{column.name: row[column] for column in table.c})
+        Change.record(table.name, "delete", result)
         db.session.commit()
+        return result
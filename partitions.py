@@ -0,0 +1,113 @@
+import os
+import re
+from datetime import date, datetime
+
+from models import db
+
+# Movie partition settings (setup.sh)
+ARCHIVE_TABLESPACE = os.environ.get('ARCHIVE_TABLESPACE', 'archive')
+# decades of partitions kept ready ahead of today
+PARTITIONS_AHEAD_YEARS = int(os.environ.get('PARTITIONS_AHEAD_YEARS', 20))
+PARTITION_YEARS = 10
+PARTITION_LOCK_TIMEOUT_MS = 5000
+
+_bounds = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def _bound(value):
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+def movie_partitions(connection):
+    # [(name, lower, upper, tablespace, estimated rows)], oldest first;
+    # an open-ended bound is None
+    rows = connection.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid),
+               coalesce(t.spcname, 'pg_default'), c.reltuples
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+        WHERE i.inhparent = 'movies'::regclass
+    """).fetchall()
+
+    partitions = []
+    for name, bound, tablespace, estimate in rows:
+        lower, upper = _bounds.search(bound).groups()
+        partitions.append(
+            (name, _bound(lower), _bound(upper), tablespace, int(estimate))
+        )
+    return sorted(partitions, key=lambda p: p[1] or datetime.min)
+
+
+def create_partitions(through_year=None):
+    # add decade partitions after the newest one up to through_year
+    if through_year is None:
+        through_year = date.today().year + PARTITIONS_AHEAD_YEARS
+    created = []
+    with db.engine.begin() as connection:
+        connection.execute(
+            "SET LOCAL lock_timeout = '{:d}ms'".format(
+                PARTITION_LOCK_TIMEOUT_MS
+            )
+        )
+        newest = movie_partitions(connection)[-1][2]
+        if newest is None:
+            return created
+        year = newest.year
+        while year <= through_year:
+            name = 'movies_y{}'.format(year)
+            connection.execute(
+                "CREATE TABLE {} PARTITION OF movies "
+                "FOR VALUES FROM ('{}-01-01') TO ('{}-01-01')".format(
+                    name, year, year + PARTITION_YEARS
+                )
+            )
+            created.append(name)
+            year += PARTITION_YEARS
+    return created
+
+
+def archive_partitions(before_year, tablespace=ARCHIVE_TABLESPACE):
+    # move the partitions that end by before_year, and their indexes, to
+    # the archive tablespace; each one is locked while it is copied
+    moved = []
+    cutoff = datetime(before_year, 1, 1)
+    with db.engine.connect() as connection:
+        for name, lower, upper, current, _ in movie_partitions(connection):
+            if upper is None or upper > cutoff or current == tablespace:
+                continue
+            with connection.begin():
+                connection.execute(
+                    "SET LOCAL lock_timeout = '{:d}ms'".format(
+                        PARTITION_LOCK_TIMEOUT_MS
+                    )
+                )
+                connection.execute('ALTER TABLE {} SET TABLESPACE {}'.format(
+                    name, tablespace
+                ))
+                indexes = connection.execute(
+                    "SELECT indexrelid::regclass::text FROM pg_index "
+                    "WHERE indrelid = '{}'::regclass".format(name)
+                ).fetchall()
+                for index, in indexes:
+                    connection.execute(
+                        'ALTER INDEX {} SET TABLESPACE {}'.format(
+                            index, tablespace
+                        )
+                    )
+            moved.append(name)
+    return moved
+
+
+def report():
+    with db.engine.connect() as connection:
+        for name, lower, upper, tablespace, estimate in movie_partitions(
+                connection):
+            print('{:<22}{:>12}{:>12}  {:<12}{:>10} rows'.format(
+                name,
+                lower.date().isoformat() if lower else '-',
+                upper.date().isoformat() if upper else '-',
+                tablespace, max(estimate, 0)
+            ))
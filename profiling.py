@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+from models import db, query_cache_stats
+
+logger = logging.getLogger('sql')
+
+# Debug / profiling mode settings (setup.sh)
+SQL_PROFILE = os.environ.get('SQL_PROFILE', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
+# Query cache settings (setup.sh)
+# each worker logs its query cache counters this often, 0 turns it off
+QUERY_CACHE_LOG_SECONDS = float(
+    os.environ.get('QUERY_CACHE_LOG_SECONDS', 300)
+)
+
+# Requests sending this header get their query profile back in
+# the X-Query-Profile response header
+PROFILE_HEADER = 'X-Profile'
+
+EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+_params = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_lists = re.compile(r"\bIN \((?:\?, )*\?\)", re.IGNORECASE)
+_values = re.compile(r"VALUES (\(.*?\))(?:, \(.*?\))+", re.IGNORECASE)
+_spaces = re.compile(r"\s+")
+
+
+def normalize(statement):
+    # collapse parameters, literals and list lengths so that the same
+    # query issued with different values counts as one statement
+    statement = _spaces.sub(' ', statement).strip()
+    statement = _params.sub('?', statement)
+    statement = _literals.sub('?', statement)
+    statement = _in_lists.sub('IN (...)', statement)
+    return _values.sub(r'VALUES \1, ...', statement)
+
+
+def explain(connection, statement, parameters):
+    # run through the raw DBAPI cursor so the EXPLAIN is not profiled
+    # itself, and inside a savepoint so a failure can't abort the
+    # request's transaction
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('SAVEPOINT sql_profile_explain')
+        try:
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute('RELEASE SAVEPOINT sql_profile_explain')
+            return plan
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT sql_profile_explain')
+            return 'EXPLAIN failed: {}'.format(e)
+    finally:
+        cursor.close()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters,
+                          context, executemany):
+    # kept on the execution context, which a failed statement simply
+    # drops; context is only missing for the dialect's own startup queries
+    if context is not None:
+        context.sql_profile_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters,
+                         context, executemany):
+    if context is None or not has_request_context():
+        return
+    elapsed = (time.perf_counter() - context.sql_profile_start) * 1000
+
+    normalized = normalize(statement)
+    g.sql_queries.append((normalized, elapsed))
+
+    if elapsed >= SLOW_QUERY_MS:
+        plan = None
+        if (not executemany and
+                statement.lstrip().lower().startswith(EXPLAINABLE)):
+            plan = explain(conn, statement, parameters)
+        logger.warning(
+            'slow query (%.1f ms) on %s %s: %s\n%s',
+            elapsed, request.method, request.path, normalized, plan
+        )
+
+
+def summarize(queries):
+    statements = OrderedDict()
+    for normalized, elapsed in queries:
+        stat = statements.setdefault(
+            normalized, {'statement': normalized, 'count': 0, 'total_ms': 0}
+        )
+        stat['count'] += 1
+        stat['total_ms'] += elapsed
+
+    for stat in statements.values():
+        stat['total_ms'] = round(stat['total_ms'], 3)
+
+    return {
+        'queries': len(queries),
+        'total_ms': round(sum(elapsed for _, elapsed in queries), 3),
+        'statements': list(statements.values())
+    }
+
+
+def possible_n_plus_one(profile, threshold=N_PLUS_ONE_THRESHOLD):
+    # the SELECTs a request issued at least threshold times
+    return [
+        stat for stat in profile['statements']
+        if stat['count'] >= threshold and
+        stat['statement'].lower().startswith('select')
+    ]
+
+
+def init_query_cache_log(app):
+    # whether or not SQL_PROFILE is on: the first request after each
+    # interval logs the worker's baked and compiled query cache counters
+    if QUERY_CACHE_LOG_SECONDS <= 0:
+        return
+    logged_at = time.monotonic()
+
+    @app.after_request
+    def log_query_cache(response):
+        nonlocal logged_at
+        now = time.monotonic()
+        if now - logged_at >= QUERY_CACHE_LOG_SECONDS:
+            logged_at = now
+            logger.info('query cache', extra={
+                'query_cache': query_cache_stats()
+            })
+        return response
+
+
+def init_profiler(app):
+    if not SQL_PROFILE:
+        return
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.before_request
+    def start_profile():
+        # /batch sub-requests add to the enclosing request's profile
+        g.setdefault('sql_queries', [])
+
+    @app.after_request
+    def finish_profile(response):
+        profile = summarize(g.get('sql_queries', []))
+
+        for stat in possible_n_plus_one(profile):
+            logger.warning(
+                'possible N+1 on %s %s: %d x %s',
+                request.method, request.path,
+                stat['count'], stat['statement']
+            )
+
+        logger.debug(
+            '%s %s issued %d queries in %.1f ms',
+            request.method, request.path,
+            profile['queries'], profile['total_ms']
+        )
+
+        if request.headers.get(PROFILE_HEADER):
+            # with the worker's baked and compiled query cache counters
+            profile['query_cache'] = query_cache_stats()
+            response.headers['X-Query-Profile'] = json.dumps(profile)
+        return response
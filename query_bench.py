@@ -0,0 +1,69 @@
+import time
+
+from models import db, Actor, Movie, Change, query_cache_stats
+
+
+def _samples():
+    actor = Actor.query.order_by(Actor.id).first()
+    movie = Movie.query.order_by(Movie.id).first()
+    if actor is None or movie is None:
+        raise SystemExit('bench_queries needs data, see manage.py seed')
+    actor_ids = [a for a, in db.session.query(Actor.id).limit(10)]
+    latest = db.session.query(db.func.max(Change.id)).scalar() or 0
+    tables = ['actors', 'movies']
+    return actor, movie, actor_ids, max(latest - 10, 0), tables
+
+
+def cases():
+    # (name, cached, uncached): the uncached side builds the same query
+    # with the plain ORM, as the routes did before
+    actor, movie, actor_ids, cursor, tables = _samples()
+    day = movie.release_date
+    db.session.remove()
+    return [
+        ('actors.get',
+         lambda: Actor.get_one(actor.id),
+         lambda: Actor.query.filter(Actor.id == actor.id).one_or_none()),
+        ('actors.find',
+         lambda: Actor.find(actor.name),
+         lambda: Actor.query.filter(Actor.name == actor.name).all()),
+        ('actors.get_many',
+         lambda: Actor.get_many(actor_ids),
+         lambda: Actor.query.filter(Actor.id.in_(actor_ids)).all()),
+        ('movies.find',
+         lambda: Movie.find(released_after=day, released_before=day),
+         lambda: Movie.query.filter(
+             Movie.release_date >= day, Movie.release_date <= day
+         ).all()),
+        ('changes.since',
+         lambda: Change.since(cursor, 10, tables),
+         lambda: Change.query.filter(
+             Change.id > cursor, Change.table_name.in_(tables)
+         ).order_by(Change.id).limit(10).all()),
+    ]
+
+
+def cpu_per_call(fn, iterations):
+    # process CPU only: the database server's time is not counted, and
+    # each call gets a fresh session like a request does
+    for _ in range(min(iterations, 50)):
+        fn()
+        db.session.remove()
+    started = time.process_time()
+    for _ in range(iterations):
+        fn()
+        db.session.remove()
+    return (time.process_time() - started) / iterations * 1e6
+
+
+def run(iterations=2000):
+    print('{:<18}{:>14}{:>14}{:>10}'.format(
+        'query', 'uncached us', 'cached us', 'saved'
+    ))
+    for name, cached, uncached in cases():
+        before = cpu_per_call(uncached, iterations)
+        after = cpu_per_call(cached, iterations)
+        print('{:<18}{:>14.1f}{:>14.1f}{:>9.0f}%'.format(
+            name, before, after, 100 * (before - after) / before
+        ))
+    print(query_cache_stats())
@@ -0,0 +1,164 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, request, has_request_context
+
+from auth import PAYLOAD_KEY
+
+logger = logging.getLogger('access')
+
+# Structured logging settings (setup.sh)
+ACCESS_LOG = os.environ.get('ACCESS_LOG', '1') == '1'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# share of 2xx requests written to the access log, errors always are
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', 1))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+# the app's loggers: Flask's (named after the app), requests, the
+# profiler and the catalog listener
+LOGGERS = ('app', 'access', 'sql', 'catalog')
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+_request_id = re.compile(r'^[\w.:-]{1,128}$')
+
+# attributes every LogRecord has, anything else was passed in extra=
+_standard = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime'
+}
+
+
+class JSONFormatter(logging.Formatter):
+    # one JSON object per line
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _standard and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestFilter(logging.Filter):
+    # tags records logged while handling a request with its id
+
+    def filter(self, record):
+        if has_request_context() and not hasattr(record, 'request_id'):
+            record.request_id = g.get('request_id')
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # the request thread only renders the message and hands the record
+    # over; a full queue drops it rather than wait on the writer
+
+    dropped = 0
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+_listener = None
+
+
+def setup_logging():
+    # records are written to stdout by a background thread, started
+    # once however many apps are created
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JSONFormatter())
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    listener = QueueListener(records, stream)
+
+    handler = NonBlockingQueueHandler(records)
+    handler.addFilter(RequestFilter())
+    for name in LOGGERS:
+        named = logging.getLogger(name)
+        named.handlers = [handler]
+        named.setLevel(LOG_LEVEL)
+        named.propagate = False
+
+    listener.start()
+    # flush what is still queued on shutdown
+    atexit.register(listener.stop)
+    _listener = listener
+    return listener
+
+
+def sampled(status):
+    if 200 <= status < 300:
+        return random.random() < ACCESS_LOG_SAMPLE_RATE
+    return True
+
+
+def init_logging(app):
+    if not ACCESS_LOG:
+        return
+
+    # before app.logger is first used, so Flask doesn't add its own
+    # stderr handler
+    setup_logging()
+
+    @app.before_request
+    def start_request():
+        # /batch sub-requests keep the id of the enclosing request
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        if not _request_id.match(request_id):
+            request_id = uuid.uuid4().hex
+        g.setdefault('request_id', request_id)
+        request.environ['request_log.start'] = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        started = request.environ.get('request_log.start')
+        if g.get('request_id'):
+            response.headers[REQUEST_ID_HEADER] = g.request_id
+
+        if started is not None and sampled(response.status_code):
+            payload = request.environ.get(PAYLOAD_KEY) or {}
+            logger.info('request', extra={
+                'method': request.method,
+                'path': request.path,
+                'route': request.url_rule.rule if request.url_rule else None,
+                'status': response.status_code,
+                'duration_ms': round(
+                    (time.perf_counter() - started) * 1000, 3
+                ),
+                'subject': payload.get('sub'),
+                'remote_addr': request.remote_addr,
+            })
+        return response
@@ -0,0 +1,188 @@
+import re
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# ValidationError Exception
+
+
+class ValidationError(Exception):
+    # raised before any database work, errors maps field -> message
+    def __init__(self, errors, status_code=422):
+        self.errors = errors
+        self.status_code = status_code
+
+
+# Converters: coerce a JSON value or raise ValueError
+
+_integer = re.compile(r'^\s*[+-]?\d+\s*$')
+_us_date = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$')
+
+
+def to_int(value):
+    # 42, 42.0 and "42"
+    if isinstance(value, bool):
+        raise ValueError('must be an integer')
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and _integer.match(value):
+        return int(value)
+    raise ValueError('must be an integer')
+
+
+def to_str(value):
+    if not isinstance(value, str):
+        raise ValueError('must be a string')
+    return value.strip()
+
+
+def _naive_utc(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def to_datetime(value):
+    # ISO 8601 (2001-02-01), MM/DD/YYYY (2/1/2001), or RFC 1123 the way
+    # the API renders dates (Thu, 01 Feb 2001 00:00:00 GMT)
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if not isinstance(value, str):
+        raise ValueError('must be a date string')
+
+    value = value.strip()
+    try:
+        return _naive_utc(datetime.fromisoformat(value))
+    except ValueError:
+        pass
+
+    match = _us_date.match(value)
+    if match:
+        month, day, year = map(int, match.groups())
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            raise ValueError('is not a valid date')
+
+    try:
+        return _naive_utc(parsedate_to_datetime(value))
+    except (TypeError, ValueError, IndexError):
+        raise ValueError(
+            'must be a date: YYYY-MM-DD, MM/DD/YYYY or RFC 1123'
+        )
+
+
+# Schemas
+
+
+class Field:
+    def __init__(self, convert, required=True, min_length=None,
+                 minimum=None, maximum=None):
+        self.convert = convert
+        self.required = required
+        self.min_length = min_length
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def compile(self):
+        # a single function converting and checking a value
+        checks = []
+        if self.min_length is not None:
+            checks.append((
+                lambda value, n=self.min_length: len(value) >= n,
+                'must not be empty' if self.min_length == 1 else
+                'must be at least {} characters'.format(self.min_length)
+            ))
+        if self.minimum is not None:
+            checks.append((
+                lambda value, n=self.minimum: value >= n,
+                'must be at least {}'.format(self.minimum)
+            ))
+        if self.maximum is not None:
+            checks.append((
+                lambda value, n=self.maximum: value <= n,
+                'must be at most {}'.format(self.maximum)
+            ))
+
+        convert = self.convert
+        if not checks:
+            return convert
+        checks = tuple(checks)
+
+        def validate(value):
+            value = convert(value)
+            for check, message in checks:
+                if not check(value):
+                    raise ValueError(message)
+            return value
+
+        return validate
+
+
+class Schema:
+    # fields are compiled when the schema is declared, validate() only
+    # runs the prebuilt functions
+
+    def __init__(self, **fields):
+        self.validators = {
+            name: field.compile() for name, field in fields.items()
+        }
+        self.compiled = tuple(
+            (name, field.required, self.validators[name])
+            for name, field in fields.items()
+        )
+
+    def validate(self, body):
+        # the request body as model values, or ValidationError
+        if not isinstance(body, dict):
+            raise ValidationError({'body': 'must be a JSON object'}, 400)
+
+        values = {}
+        errors = {}
+        for name, required, validate in self.compiled:
+            value = body.get(name)
+            if value is None:
+                if required:
+                    errors[name] = 'is required'
+                continue
+            try:
+                values[name] = validate(value)
+            except ValueError as e:
+                errors[name] = str(e)
+
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+    def row_validator(self, columns):
+        # for bulk loads: checks and coerces tuples in column order
+        validators = tuple(self.validators[column] for column in columns)
+
+        def validate(row):
+            values = []
+            for column, validate_value, value in zip(
+                    columns, validators, row):
+                try:
+                    values.append(validate_value(value))
+                except ValueError as e:
+                    raise ValidationError({column: '{} ({!r})'.format(
+                        e, value
+                    )})
+            return tuple(values)
+
+        return validate
+
+
+ACTOR = Schema(
+    name=Field(to_str, min_length=1),
+    age=Field(to_int, minimum=0, maximum=150),
+    gender=Field(to_str, min_length=1),
+)
+
+MOVIE = Schema(
+    title=Field(to_str, min_length=1),
+    release_date=Field(to_datetime),
+)
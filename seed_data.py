@@ -0,0 +1,265 @@
+import random
+import re
+import time
+from datetime import date
+from itertools import islice
+from multiprocessing import Pool
+
+import psycopg2
+
+from models import db, Change, Stat
+from schemas import ACTOR, MOVIE
+
+FIRST_NAMES = [
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael",
+    "Linda", "David", "Elizabeth", "William", "Barbara", "Richard", "Susan",
+    "Joseph", "Jessica", "Thomas", "Sarah", "Omar", "Karen", "Ahmad", "Lina",
+    "Yusuf", "Noor", "Hiro", "Yuki", "Carlos", "Sofia", "Mateo", "Valentina",
+    "Wei", "Mei", "Arjun", "Priya", "Kwame", "Amara", "Ivan", "Olga",
+    "Lucas", "Emma", "Noah", "Olivia", "Liam", "Ava", "Elijah", "Mia",
+]
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller",
+    "Davis", "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez",
+    "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Alsalieti", "Haddad", "Khalil", "Tanaka", "Suzuki", "Chen", "Wang",
+    "Patel", "Sharma", "Mensah", "Okafor", "Ivanov", "Petrova", "Rossi",
+    "Muller", "Dubois", "Silva", "Santos", "Kowalski", "Nielsen",
+]
+TITLE_WORDS = [
+    "Silent", "Dark", "Last", "Lost", "Golden", "Broken", "Hidden", "Red",
+    "Wild", "Final", "Eternal", "Crimson", "Frozen", "Burning", "Secret",
+    "Distant", "Empty", "Savage", "Quiet", "Fallen", "Electric", "Midnight",
+]
+TITLE_NOUNS = [
+    "River", "City", "Kingdom", "Road", "Empire", "Dream", "Horizon",
+    "Storm", "Garden", "Shadow", "Ocean", "Mountain", "Night", "Promise",
+    "Frontier", "Harbor", "Echo", "Signal", "Witness", "Voyage", "Summer",
+    "Winter", "Machine", "Letter", "Island", "Station", "Crown", "Heart",
+]
+
+# rows generated per batch of rng calls, and per chunk handed to COPY
+BATCH_ROWS = 10000
+
+# highest sequel number among the existing titles, 1 for an unnumbered one
+TITLE_OFFSET = """
+    SELECT coalesce(max(
+        coalesce(substring(title from ' ([0-9]{1,9})$')::int, 1)
+    ), 0) FROM movies
+"""
+
+# the copied rows are not in the change log: /changes clients get one
+# reload marker per table instead and fetch the tables again
+RELOAD_CHANGES = """
+    INSERT INTO changes (table_name, operation, row_id)
+    VALUES ('actors', 'reload', 0), ('movies', 'reload', 0)
+"""
+
+_specials = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'
+})
+_needs_escape = re.compile(r'[\\\t\n\r]').search
+
+
+def _copy_value(value):
+    if not isinstance(value, str):
+        return str(value)
+    if _needs_escape(value):
+        return value.translate(_specials)
+    return value
+
+
+def copy_line(row):
+    # one row in COPY text format
+    return '\t'.join(map(_copy_value, row)) + '\n'
+
+
+class CopyStream:
+    # file-like object that COPY FROM STDIN reads rows from as they
+    # are generated, so nothing is held in memory
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b''
+        self.count = 0
+
+    def read(self, size=1 << 20):
+        while len(self.buffer) < size:
+            lines = [copy_line(row) for row in islice(self.rows, BATCH_ROWS)]
+            if not lines:
+                break
+            self.count += len(lines)
+            self.buffer += ''.join(lines).encode('utf-8')
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def generate_actors(rng, count, mean_age=38, age_spread=14,
+                    female_share=0.48, nonbinary_share=0.02):
+    genders = ["female", "non-binary", "male"]
+    weights = [female_share, nonbinary_share,
+               1 - female_share - nonbinary_share]
+    for start in range(0, count, BATCH_ROWS):
+        size = min(BATCH_ROWS, count - start)
+        first_names = rng.choices(FIRST_NAMES, k=size)
+        last_names = rng.choices(LAST_NAMES, k=size)
+        ages = [
+            min(max(int(rng.gauss(mean_age, age_spread)), 5), 95)
+            for _ in range(size)
+        ]
+        for first, last, age, gender in zip(
+                first_names, last_names, ages,
+                rng.choices(genders, weights, k=size)):
+            yield first + ' ' + last, age, gender
+
+
+def generate_movies(rng, count, shard=0, jobs=1, first_year=1920,
+                    last_year=2026, recent_bias=15, title_offset=0):
+    # release years fall off exponentially going back from last_year,
+    # recent_bias is the mean number of years back
+    seen = {}
+    end = date(last_year, 12, 31).toordinal()
+    max_days = (last_year - first_year) * 365
+    mean_days = recent_bias * 365
+    for start in range(0, count, BATCH_ROWS):
+        size = min(BATCH_ROWS, count - start)
+        words = rng.choices(TITLE_WORDS, k=size)
+        nouns = rng.choices(TITLE_NOUNS, k=size)
+        for word, noun in zip(words, nouns):
+            base = 'The ' + word + ' ' + noun
+            # titles are unique: repeat bases get a sequel number, and
+            # shards number their sequels apart from each other; a load
+            # into a non-empty table numbers after title_offset
+            seen[base] = seen.get(base, 0) + 1
+            number = title_offset + (seen[base] - 1) * jobs + shard + 1
+            title = base if number == 1 else base + ' ' + str(number)
+
+            days_back = min(int(rng.expovariate(1 / mean_days)), max_days)
+            yield title, date.fromordinal(end - days_back)
+
+
+# rows go through the same schemas as the API's request bodies
+TABLES = {
+    'actors': (('name', 'age', 'gender'), generate_actors, ACTOR),
+    'movies': (('title', 'release_date'), generate_movies, MOVIE),
+}
+
+
+def copy_shard(connect_args, table, count, seed, shard, jobs, options):
+    # COPY one shard of generated rows over its own connection
+    columns, generate, schema = TABLES[table]
+    if table == 'movies':
+        options = dict(options, shard=shard, jobs=jobs)
+    rng = random.Random('{}:{}:{}'.format(seed, table, shard))
+
+    cargs, cparams = connect_args
+    connection = psycopg2.connect(*cargs, **cparams)
+    try:
+        stream = CopyStream(map(
+            schema.row_validator(columns), generate(rng, count, **options)
+        ))
+        connection.cursor().copy_expert(
+            'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)),
+            stream, size=1 << 20
+        )
+        connection.commit()
+        return stream.count
+    finally:
+        connection.close()
+
+
+def copy_table(connect_args, table, count, seed, jobs, options):
+    shards = [
+        (connect_args, table, count // jobs + (shard < count % jobs),
+         seed, shard, jobs, options)
+        for shard in range(jobs)
+    ]
+    started = time.perf_counter()
+    if jobs == 1:
+        copied = copy_shard(*shards[0])
+    else:
+        with Pool(jobs) as pool:
+            copied = sum(pool.starmap(copy_shard, shards))
+    elapsed = time.perf_counter() - started
+    print('copied {} {} in {:.1f}s ({:.0f} rows/s)'.format(
+        copied, table, elapsed, copied / max(elapsed, 1e-9)
+    ))
+
+
+def seed(actors, movies, seed=0, truncate=False, jobs=1, **distribution):
+    actor_options = {
+        key: distribution[key] for key in
+        ('mean_age', 'age_spread', 'female_share', 'nonbinary_share')
+        if distribution.get(key) is not None
+    }
+    movie_options = {
+        key: distribution[key] for key in
+        ('first_year', 'last_year', 'recent_bias')
+        if distribution.get(key) is not None
+    }
+    engine = db.engine
+    connect_args = engine.dialect.create_connect_args(engine.url)
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # the change log lock first, as every writer takes it
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (Change.LOCK_ID,))
+        if truncate:
+            cursor.execute(
+                'TRUNCATE actors, movies, movie_titles, stats '
+                'RESTART IDENTITY'
+            )
+            # change ids carry on, so the reload markers land after every
+            # client's cursor
+            cursor.execute('TRUNCATE changes')
+        else:
+            # appending: start the sequel numbers after every existing
+            # one so a second run cannot repeat a title
+            cursor.execute(TITLE_OFFSET)
+            movie_options['title_offset'] = cursor.fetchone()[0]
+
+        # one NOTIFY per copied row would flood the catalog listeners,
+        # they get a single reload message at the end instead
+        cursor.execute(
+            'ALTER TABLE actors DISABLE TRIGGER actors_notify_catalog_change'
+        )
+        cursor.execute(
+            'ALTER TABLE movies DISABLE TRIGGER movies_notify_catalog_change'
+        )
+        connection.commit()
+
+        try:
+            copy_table(connect_args, 'actors', actors, seed, jobs,
+                       actor_options)
+            copy_table(connect_args, 'movies', movies, seed, jobs,
+                       movie_options)
+        finally:
+            connection.rollback()
+            # the change log lock first, as every writer takes it
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(%s)', (Change.LOCK_ID,)
+            )
+            cursor.execute(
+                'ALTER TABLE actors ENABLE TRIGGER '
+                'actors_notify_catalog_change'
+            )
+            cursor.execute(
+                'ALTER TABLE movies ENABLE TRIGGER '
+                'movies_notify_catalog_change'
+            )
+            cursor.execute(
+                "SELECT pg_notify('catalog_changes', '{\"reload\": true}')"
+            )
+            cursor.execute(RELOAD_CHANGES)
+            connection.commit()
+
+        cursor.execute('ANALYZE actors')
+        cursor.execute('ANALYZE movies')
+        connection.commit()
+    finally:
+        connection.close()
+
+    # the copied rows bypassed the model hooks
+    Stat.rebuild()
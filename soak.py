@@ -0,0 +1,384 @@
+import gc
+import os
+import random
+import resource
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import request
+
+from auth import PAYLOAD_KEY
+from models import db
+
+PERMISSIONS = [
+    "get:actors", "get:movies", "post:actors", "post:movies",
+    "patch:actors", "patch:movies", "delete:actors", "delete:movie"
+]
+
+# rows created by the soak that are kept around for reads and updates,
+# older ones are deleted
+MAX_OWN_ROWS = 200
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        # peak rather than current RSS, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def object_counts():
+    gc.collect()
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def trust_requests(app, permissions=PERMISSIONS):
+    # skip JWT verification: authenticate() takes a payload already in
+    # the request's environ
+    payload = {"sub": "soak", "permissions": permissions}
+
+    def set_payload():
+        request.environ[PAYLOAD_KEY] = payload
+
+    app.before_request_funcs.setdefault(None, []).insert(0, set_payload)
+
+
+class Soak:
+    def __init__(self, app, token=None, seed=0):
+        self.app = app
+        self.headers = {}
+        if token:
+            self.headers['Authorization'] = 'Bearer ' + token
+        else:
+            trust_requests(app)
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.actors = []
+        self.movies = []
+        self.latencies = []
+        self.statuses = Counter()
+        self.inflight = 0
+        self.stopping = threading.Event()
+
+    # Workload
+
+    def request(self, client, method, path, **kw):
+        headers = dict(self.headers, **kw.pop('headers', {}))
+        with self.lock:
+            self.inflight += 1
+        started = time.perf_counter()
+        try:
+            response = getattr(client, method)(path, headers=headers, **kw)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.inflight -= 1
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.statuses[response.status_code] += 1
+        return response
+
+    def pick(self, rng, rows):
+        with self.lock:
+            return rng.choice(rows) if rows else None
+
+    def keep(self, rows, row_id, client, path):
+        with self.lock:
+            rows.append(row_id)
+            old = rows.pop(0) if len(rows) > MAX_OWN_ROWS else None
+        if old is not None:
+            self.request(client, 'delete', path.format(old))
+
+    def read_actors(self, client, rng):
+        actor_id = self.pick(rng, self.actors)
+        if actor_id is None:
+            return self.request(client, 'get', '/actors?ids=1,2,3')
+        return self.request(client, 'get', '/actors/{}'.format(actor_id))
+
+    def read_movies(self, client, rng):
+        year = rng.randint(1990, 2025)
+        return self.request(
+            client, 'get',
+            '/movies?released_after={0}-01-01&released_before={0}-01-31'
+            .format(year)
+        )
+
+    def read_many(self, client, rng):
+        with self.lock:
+            ids = self.actors[-20:]
+        return self.request(
+            client, 'get', '/actors?ids=' + ','.join(map(str, ids or [1]))
+        )
+
+    def read_changes(self, client, rng):
+        return self.request(client, 'get', '/changes?since=0&limit=50')
+
+    def read_stats(self, client, rng):
+        return self.request(client, 'get', '/stats')
+
+    def create_actor(self, client, rng):
+        response = self.request(client, 'post', '/actors', json={
+            "name": "soak " + uuid.uuid4().hex[:8],
+            "age": rng.randint(5, 90),
+            "gender": rng.choice(["female", "male", "non-binary"])
+        })
+        if response.status_code == 200:
+            actor_id = response.get_json()['created_actor']['id']
+            self.keep(self.actors, actor_id, client, '/actors/{}')
+        return response
+
+    def create_movie(self, client, rng):
+        response = self.request(client, 'post', '/movies', json={
+            "title": "soak " + uuid.uuid4().hex,
+            "release_date": "{}-{:02d}-{:02d}".format(
+                rng.randint(1990, 2025), rng.randint(1, 12), rng.randint(1, 28)
+            )
+        })
+        if response.status_code == 200:
+            movie_id = response.get_json()['created_movie']['id']
+            self.keep(self.movies, movie_id, client, '/movies/{}')
+        return response
+
+    def update_actor(self, client, rng):
+        actor_id = self.pick(rng, self.actors)
+        if actor_id is None:
+            return self.create_actor(client, rng)
+        headers = {}
+        if rng.random() < 0.2:
+            # mostly stale, exercises the 412 path
+            headers['If-Match'] = '"1"'
+        return self.request(
+            client, 'patch', '/actors/{}'.format(actor_id), headers=headers,
+            json={"name": "soak updated", "age": rng.randint(5, 90),
+                  "gender": "female"}
+        )
+
+    def update_movie(self, client, rng):
+        movie_id = self.pick(rng, self.movies)
+        if movie_id is None:
+            return self.create_movie(client, rng)
+        return self.request(
+            client, 'patch', '/movies/{}'.format(movie_id),
+            json={"title": "soak " + uuid.uuid4().hex,
+                  "release_date": "2001-02-0{}".format(rng.randint(1, 9))}
+        )
+
+    def invalid_writes(self, client, rng):
+        # the failure paths: missing fields, unparseable values, missing
+        # rows
+        case = rng.randrange(4)
+        if case == 0:
+            return self.request(client, 'patch', '/actors/0', json={})
+        if case == 1:
+            return self.request(client, 'post', '/actors', json={
+                "name": "soak", "age": "not a number", "gender": "male"
+            })
+        if case == 2:
+            return self.request(client, 'post', '/movies', json={
+                "title": "soak " + uuid.uuid4().hex,
+                "release_date": "not a date"
+            })
+        return self.request(client, 'delete', '/movies/0')
+
+    def batch(self, client, rng):
+        actor_id = self.pick(rng, self.actors) or 0
+        return self.request(client, 'post', '/batch', json={
+            "atomic": rng.random() < 0.5,
+            "operations": [
+                {"method": "GET", "path": "/actors/{}".format(actor_id)},
+                {"method": "POST", "path": "/actors", "body": {
+                    "name": "soak", "age": "x", "gender": "male"
+                }},
+                {"method": "PATCH", "path": "/actors/{}".format(actor_id),
+                 "body": {"name": "soak batch", "age": 33,
+                          "gender": "male"}},
+            ]
+        })
+
+    WORKLOAD = [
+        (30, read_actors), (20, read_movies), (10, read_many),
+        (3, read_changes), (3, read_stats), (8, create_actor),
+        (5, create_movie), (8, update_actor), (5, update_movie),
+        (5, invalid_writes), (3, batch),
+    ]
+
+    def worker(self, number):
+        rng = random.Random('{}:{}'.format(self.seed, number))
+        operations = [op for _, op in self.WORKLOAD]
+        weights = [weight for weight, _ in self.WORKLOAD]
+        client = self.app.test_client()
+        while not self.stopping.is_set():
+            operation = rng.choices(operations, weights)[0]
+            try:
+                operation(self, client, rng)
+            except Exception as e:
+                with self.lock:
+                    self.statuses['exception ' + type(e).__name__] += 1
+
+    # Sampling
+
+    def sample(self):
+        # pg first: its connection is back in the pool before counting
+        with db.engine.connect() as connection:
+            idle_in_transaction = connection.execute(
+                "SELECT count(*) FROM pg_stat_activity "
+                "WHERE datname = current_database() "
+                "AND state = 'idle in transaction' "
+                "AND pid <> pg_backend_pid()"
+            ).scalar()
+
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            statuses, self.statuses = self.statuses, Counter()
+            inflight = self.inflight
+
+        objects = object_counts()
+        return {
+            "time": time.monotonic(),
+            "rss_mb": rss_mb(),
+            "objects": sum(objects.values()),
+            "object_types": objects,
+            # checked out connections and live sessions beyond the
+            # requests in flight were leaked
+            "leaked_connections": max(
+                db.engine.pool.checkedout() - inflight, 0
+            ),
+            "leaked_sessions": max(
+                len(db.session.registry.registry) - inflight, 0
+            ),
+            "idle_in_transaction": idle_in_transaction,
+            "requests": len(latencies),
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95),
+            "statuses": statuses,
+        }
+
+    def cleanup(self):
+        client = self.app.test_client()
+        for actor_id in self.actors:
+            self.request(client, 'delete', '/actors/{}'.format(actor_id))
+        for movie_id in self.movies:
+            self.request(client, 'delete', '/movies/{}'.format(movie_id))
+
+
+def report(sample, elapsed):
+    statuses = ' '.join(
+        '{}:{}'.format(status, count)
+        for status, count in sorted(sample['statuses'].items(), key=str)
+    )
+    print(
+        '{:>7.0f}s rss {:7.1f} MB  objects {:>8}  leaked conn {} '
+        'sess {}  idle-in-tx {}  reqs {:>6}  p50 {:6.1f} ms  '
+        'p95 {:6.1f} ms  {}'.format(
+            elapsed, sample['rss_mb'], sample['objects'],
+            sample['leaked_connections'], sample['leaked_sessions'],
+            sample['idle_in_transaction'], sample['requests'],
+            sample['p50_ms'], sample['p95_ms'], statuses
+        ), flush=True
+    )
+
+
+def check(baseline, final, statuses, max_rss_growth, max_object_growth,
+          max_latency_drift):
+    failures = []
+    rss_growth = final['rss_mb'] - baseline['rss_mb']
+    if rss_growth > max_rss_growth:
+        failures.append('RSS grew {:.1f} MB (limit {} MB)'.format(
+            rss_growth, max_rss_growth
+        ))
+
+    object_growth = 100.0 * (
+        final['objects'] - baseline['objects']) / baseline['objects']
+    if object_growth > max_object_growth:
+        growing = (final['object_types'] - baseline['object_types'])
+        failures.append('objects grew {:.0f}% (limit {}%), most: {}'.format(
+            object_growth, max_object_growth,
+            ', '.join('{} +{}'.format(*item)
+                      for item in growing.most_common(5))
+        ))
+
+    if (baseline['p95_ms'] and
+            final['p95_ms'] > baseline['p95_ms'] * max_latency_drift):
+        failures.append('p95 latency drifted {:.1f} -> {:.1f} ms '
+                        '(limit x{})'.format(baseline['p95_ms'],
+                                             final['p95_ms'],
+                                             max_latency_drift))
+
+    if final['leaked_connections'] or final['leaked_sessions']:
+        failures.append('{} pool connections and {} sessions left open '
+                        'after the workload stopped'.format(
+                            final['leaked_connections'],
+                            final['leaked_sessions']))
+
+    # 5xx responses are reported but some invalid inputs still get them,
+    # only exceptions escaping the app fail the soak
+    exceptions = sum(count for status, count in statuses.items()
+                     if not isinstance(status, int))
+    if exceptions:
+        failures.append('{} requests raised'.format(exceptions))
+    return failures
+
+
+def run(app, duration=3600, interval=60, warmup=120, threads=4, seed=0,
+        token=None, max_rss_growth=50, max_object_growth=20,
+        max_latency_drift=1.5):
+    soak = Soak(app, token, seed)
+    workers = [
+        threading.Thread(target=soak.worker, args=(number,), daemon=True)
+        for number in range(threads)
+    ]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+
+    # the first window after warmup is the baseline, once caches, pools
+    # and the interpreter have settled
+    time.sleep(warmup)
+    soak.sample()
+    baseline = None
+    statuses = Counter()
+    windows = []
+    try:
+        while time.monotonic() - started < warmup + duration:
+            time.sleep(min(interval,
+                           warmup + duration - (time.monotonic() - started)))
+            sample = soak.sample()
+            statuses.update(sample['statuses'])
+            report(sample, time.monotonic() - started)
+            windows.append(sample)
+            if baseline is None:
+                baseline = sample
+    finally:
+        soak.stopping.set()
+        for worker in workers:
+            worker.join()
+
+    # with every worker stopped nothing may still hold a connection
+    final = soak.sample()
+    statuses.update(final['statuses'])
+    final['p95_ms'] = windows[-1]['p95_ms'] if windows else 0.0
+    soak.cleanup()
+
+    failures = check(baseline or final, final, statuses, max_rss_growth,
+                     max_object_growth, max_latency_drift)
+    print('responses: ' + ' '.join(
+        '{}:{}'.format(status, count)
+        for status, count in sorted(statuses.items(), key=str)
+    ))
+    for failure in failures:
+        print('FAIL:', failure)
+    if not failures:
+        print('soak passed')
+    return not failures
@@ -1,10 +1,20 @@
 import os
+import random
+import threading
+import time
 import unittest
 import json
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
 from app import app
-from models import setup_db, Movie, Actor, database_path
+from auth import PAYLOAD_KEY
+from sqlalchemy import create_engine, text
+from models import setup_db, Movie, MovieTitle, Actor, Change, database_path
+from catalog import CatalogSnapshot
+from seed_data import generate_actors, generate_movies
+import profiling
+from profiling import normalize, summarize, possible_n_plus_one
 from flask import request, _request_ctx_stack, abort
 
 
@@ -59,6 +69,18 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    def test_get_movies_released_between(self):
+        res = self.client().get(
+            '/movies?released_after=2020-01-01&released_before=2020-12-31',
+            headers={
+                "Authorization": f"Bearer {CASTING_ASSISTANT}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for movie in data['movies']:
+            self.assertIn('2020', movie['release_date'])
+
     def test_create_new_movie(self):
         res = self.client().post(
             '/movies',
@@ -95,6 +117,71 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
 
     # test Actors endpoint
+    def test_422_duplicate_title_in_another_partition(self):
+        # titles are unique through movie_titles, across the partitions
+        headers = {"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        title = f"Partition Test {time.time_ns()}"
+        res = self.client().post('/movies', headers=headers, json={
+            "title": title, "release_date": "1955-05-05"
+        })
+        self.assertEqual(res.status_code, 200)
+        movie_id = json.loads(res.data)['created_movie']['id']
+
+        res = self.client().post('/movies', headers=headers, json={
+            "title": title, "release_date": "2015-05-05"
+        })
+        self.client().delete(f'/movies/{movie_id}', headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+    def test_patch_moves_movie_to_another_partition(self):
+        headers = {"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        title = f"Partition Test {time.time_ns()}"
+        res = self.client().post('/movies', headers=headers, json={
+            "title": title, "release_date": "1955-05-05"
+        })
+        movie_id = json.loads(res.data)['created_movie']['id']
+
+        res = self.client().patch(f'/movies/{movie_id}', headers=headers,
+                                  json={"title": title + " moved",
+                                        "release_date": "2015-05-05"})
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            row = MovieTitle.query.filter_by(movie_id=movie_id).one()
+            self.assertEqual(row.title, title + " moved")
+            self.assertEqual(row.release_date, datetime(2015, 5, 5))
+            self.assertIsNone(MovieTitle.query.get(title))
+
+        res = self.client().get(f'/movies/{movie_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(
+            '/movies?released_after=2015-05-01&released_before=2015-05-31',
+            headers=headers
+        )
+        ids = [movie['id'] for movie in json.loads(res.data)['movies']]
+        res = self.client().get(
+            '/movies?released_before=1955-12-31', headers=headers
+        )
+        old_ids = [movie['id'] for movie in json.loads(res.data)['movies']]
+        self.client().delete(f'/movies/{movie_id}', headers=headers)
+
+        self.assertIn(movie_id, ids)
+        self.assertNotIn(movie_id, old_ids)
+
+    def test_query_cache_logged(self):
+        interval = profiling.QUERY_CACHE_LOG_SECONDS
+        profiling.QUERY_CACHE_LOG_SECONDS = 0.001
+        try:
+            time.sleep(0.002)
+            with self.assertLogs('sql', 'INFO') as logs:
+                self.client().get('/actors', headers={
+                    "Authorization": f"Bearer {CASTING_ASSISTANT}"
+                })
+        finally:
+            profiling.QUERY_CACHE_LOG_SECONDS = interval
+        record = logs.records[-1]
+        self.assertEqual(record.getMessage(), 'query cache')
+        self.assertIn('actors.find', record.query_cache['baked'])
+
     def test_get_actors(self):
         res = self.client().get(
             '/actors',
@@ -106,6 +193,36 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_get_actors_by_ids(self):
+        res = self.client().post(
+            '/actors',
+            headers={
+                "Authorization": f"Bearer {EXECUTIVE_PRODUCER}"
+            }, json=self.new_actor
+        )
+        actor_id = json.loads(res.data)['created_actor']['id']
+        res = self.client().get(
+            '/actors?ids={},987654'.format(actor_id),
+            headers={
+                "Authorization": f"Bearer {CASTING_ASSISTANT}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'][0]['id'], actor_id)
+        self.assertEqual(data['missing'], [987654])
+
+    def test_400_get_actors_by_too_many_ids(self):
+        res = self.client().get(
+            '/actors?ids=' + ','.join(str(i) for i in range(1, 1000)),
+            headers={
+                "Authorization": f"Bearer {CASTING_ASSISTANT}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_create_new_actor(self):
         res = self.client().post(
             '/actors',
@@ -116,6 +233,19 @@ class CastingAgencyTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+        self.assertEqual(data['created_actor']['age'], 42)
+
+    def test_422_create_actor_invalid_age(self):
+        res = self.client().post(
+            '/actors',
+            headers={
+                "Authorization": f"Bearer {EXECUTIVE_PRODUCER}"
+            }, json={"name": "James McAvoy", "age": "old", "gender": "male"}
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(list(data['errors']), ['age'])
 
     def test_delete_actor(self):
         create_actor = {
@@ -174,6 +304,274 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['patched_actor'])
 
+    # test Stats endpoint
+    def test_get_stats(self):
+        res = self.client().get(
+            '/stats',
+            headers={
+                "Authorization": f"Bearer {CASTING_ASSISTANT}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn('by_gender', data['stats']['actors'])
+        self.assertIn('by_release_year', data['stats']['movies'])
+
+    def test_get_stats_without_movie_permission(self):
+        # no role lacks get:movies, so hand the view a verified payload
+        res = self.client().get('/stats', environ_base={
+            PAYLOAD_KEY: {"sub": "tester", "permissions": ["get:actors"]}
+        })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('actors', data['stats'])
+        self.assertNotIn('movies', data['stats'])
+
+    def test_stats_count_new_actor(self):
+        headers = {"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        before = json.loads(
+            self.client().get('/stats', headers=headers).data
+        )['stats']['actors']
+        res = self.client().post('/actors', headers=headers, json={
+            "name": "Stats Tester", "age": 42, "gender": "stats-tester"
+        })
+        actor_id = json.loads(res.data)['created_actor']['id']
+        after = json.loads(
+            self.client().get('/stats', headers=headers).data
+        )['stats']['actors']
+        self.client().delete(f'/actors/{actor_id}', headers=headers)
+
+        self.assertEqual(after['total'], before['total'] + 1)
+        self.assertEqual(after['by_gender']['stats-tester'],
+                         before['by_gender'].get('stats-tester', 0) + 1)
+        self.assertEqual(after['by_age']['40-49'],
+                         before['by_age'].get('40-49', 0) + 1)
+
+    def test_writer_takes_change_log_lock_first(self):
+        # the other connection plays an atomic /batch: it holds the change
+        # log lock and goes on to the ("actors", "total") counter while a
+        # plain POST /actors waits for the lock, which must not deadlock
+        headers = {"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        responses = []
+        writer = threading.Thread(target=lambda: responses.append(
+            self.client().post('/actors', headers=headers, json={
+                "name": "Lock Tester", "age": 42, "gender": "male"
+            })
+        ))
+
+        engine = create_engine(database_path)
+        with engine.connect() as batch:
+            transaction = batch.begin()
+            try:
+                batch.execute(
+                    text('SELECT pg_advisory_xact_lock(:lock_id)'),
+                    lock_id=Change.LOCK_ID
+                )
+                writer.start()
+                for _ in range(100):
+                    waiting = batch.execute(text(
+                        "SELECT count(*) FROM pg_locks "
+                        "WHERE locktype = 'advisory' AND NOT granted"
+                    )).scalar()
+                    if waiting:
+                        break
+                    time.sleep(0.05)
+                self.assertTrue(waiting)
+
+                batch.execute(text("SET LOCAL lock_timeout = '5s'"))
+                batch.execute(text(
+                    "UPDATE stats SET count = count "
+                    "WHERE metric = 'actors' AND bucket = 'total'"
+                ))
+            finally:
+                transaction.rollback()
+                writer.join()
+        engine.dispose()
+
+        self.assertEqual(responses[0].status_code, 200)
+        actor_id = json.loads(responses[0].data)['created_actor']['id']
+        self.client().delete(f'/actors/{actor_id}', headers=headers)
+
+    def test_request_id_header(self):
+        res = self.client().get(
+            '/actors',
+            headers={
+                "Authorization": f"Bearer {CASTING_ASSISTANT}",
+                "X-Request-ID": "test-request-1"
+            }
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Request-ID'], 'test-request-1')
+
+    # test health endpoints
+    def test_get_healthz(self):
+        res = self.client().get('/healthz')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['checks']['database']['ok'])
+        # public probes carry no error details or worker internals
+        self.assertNotIn('query_cache', data)
+        for check in data['checks'].values():
+            self.assertEqual(set(check), {'ok', 'duration_ms'})
+
+    def test_get_readyz(self):
+        res = self.client().get('/readyz')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['status'], 'ready')
+
+    def test_412_patch_actor_stale_version(self):
+        res = self.client().post(
+            '/actors',
+            headers={
+                "Authorization": f"Bearer {EXECUTIVE_PRODUCER}"
+            }, json=self.new_actor
+        )
+        actor_id = json.loads(res.data)['created_actor']['id']
+        res = self.client().patch(
+            '/actors/{}'.format(actor_id),
+            json={"name": "odai", "age": 36, "gender": "male"},
+            headers={
+                "Authorization": f"Bearer {EXECUTIVE_PRODUCER}",
+                "If-Match": '"0"'
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Precondition failed')
+
+    def test_patch_actor_current_version(self):
+        headers = {"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        res = self.client().post('/actors', headers=headers,
+                                 json=self.new_actor)
+        actor_id = json.loads(res.data)['created_actor']['id']
+        etag = res.headers['ETag']
+
+        res = self.client().patch(
+            f'/actors/{actor_id}',
+            json={"name": "odai", "age": 36, "gender": "male"},
+            headers=dict(headers, **{"If-Match": etag})
+        )
+        self.client().delete(f'/actors/{actor_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['patched_actor']['name'],
+                         'odai')
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_412_delete_actor_stale_version(self):
+        headers = {"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        res = self.client().post('/actors', headers=headers,
+                                 json=self.new_actor)
+        actor_id = json.loads(res.data)['created_actor']['id']
+
+        res = self.client().delete(
+            f'/actors/{actor_id}',
+            headers=dict(headers, **{"If-Match": '"0"'})
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['message'], 'Precondition failed')
+        res = self.client().delete(f'/actors/{actor_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_400_malformed_if_match(self):
+        headers = {"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        for if_match in ('"abc"', '"1", "2"', 'W/"1"'):
+            res = self.client().patch(
+                '/actors/1',
+                json={"name": "odai", "age": 36, "gender": "male"},
+                headers=dict(headers, **{"If-Match": if_match})
+            )
+            self.assertEqual(res.status_code, 400, if_match)
+
+    # test Changes endpoint
+    def test_get_changes_since_cursor(self):
+        # page to the newest change first
+        cursor, has_more = 0, True
+        while has_more:
+            res = self.client().get(
+                '/changes?since={}&limit=1000'.format(cursor),
+                headers={"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+            )
+            data = json.loads(res.data)
+            cursor, has_more = data['cursor'], data['has_more']
+        self.client().post(
+            '/actors',
+            headers={"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"},
+            json=self.new_actor
+        )
+        res = self.client().get(
+            '/changes?since={}'.format(cursor),
+            headers={"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"}
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['changes'][-1]['operation'], 'insert')
+        self.assertEqual(data['changes'][-1]['data']['name'],
+                         self.new_actor['name'])
+        self.assertGreater(data['cursor'], cursor)
+
+    # test Batch endpoint
+    def test_batch(self):
+        res = self.client().post(
+            '/batch',
+            headers={"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"},
+            json={"operations": [
+                {"method": "POST", "path": "/actors", "body": self.new_actor},
+                {"method": "GET", "path": "/actors/987654"}
+            ]}
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['status'], 200)
+        self.assertEqual(data['results'][1]['status'], 404)
+
+    def test_atomic_batch_rolls_back_every_write(self):
+        res = self.client().post(
+            '/batch',
+            headers={"Authorization": f"Bearer {EXECUTIVE_PRODUCER}"},
+            json={"atomic": True, "operations": [
+                {"method": "POST", "path": "/actors", "body": self.new_actor},
+                {"method": "GET", "path": "/actors/987654"}
+            ]}
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0],
+                         {"status": 424, "headers": {}, "body": None})
+        self.assertEqual(data['results'][1]['status'], 404)
+
+    def test_batch_checks_each_permission(self):
+        res = self.client().post(
+            '/batch',
+            headers={"Authorization": f"Bearer {CASTING_ASSISTANT}"},
+            json={"operations": [
+                {"method": "GET", "path": "/movies"},
+                {"method": "DELETE", "path": "/actors/2"}
+            ]}
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['status'], 200)
+        self.assertEqual(data['results'][1]['status'], 401)
+
+    def test_token_checked_per_request_in_one_app_context(self):
+        # requests pushed inside an existing app context share its g
+        with self.app.app_context():
+            res = self.client().get('/actors', headers={
+                "Authorization": f"Bearer {EXECUTIVE_PRODUCER}"
+            })
+            self.assertEqual(res.status_code, 200)
+            res = self.client().delete('/actors/987654', headers={
+                "Authorization": f"Bearer {CASTING_ASSISTANT}"
+            })
+            self.assertEqual(res.status_code, 401)
+            res = self.client().get('/actors')
+            self.assertEqual(res.status_code, 401)
+
     # test RBAC and test for error behavior of each endpoint
     def test_401_get_actors_without_permessions(self):
         res = self.client().get('/actors')
@@ -211,7 +609,7 @@ class CastingAgencyTestCase(unittest.TestCase):
     def test_404_patch_movie(self):
         response = self.client().patch(
             '/movies/12323',
-            json=self.test_movie,
+            json={"title": "Tom and jerry", "release_date": "2/15/2021"},
             headers={'Authorization': f'Bearer {EXECUTIVE_PRODUCER}'}
         )
         data = json.loads(response.data)
@@ -220,6 +618,17 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data['error'], 404)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_422_patch_movie_invalid_release_date(self):
+        response = self.client().patch(
+            '/movies/12323',
+            json=self.test_movie,
+            headers={'Authorization': f'Bearer {EXECUTIVE_PRODUCER}'}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertIn('release_date', data['errors'])
+
     def test_401_patch_movie_unauthorized(self):
         response = self.client().patch(
             '/movies/1',
@@ -253,17 +662,17 @@ class CastingAgencyTestCase(unittest.TestCase):
             }
         )
 
-    def test_422_delete_movie(self):
+    def test_404_delete_movie(self):
         response = self.client().delete(
             '/movies/22321',
             headers={'Authorization': f'Bearer {EXECUTIVE_PRODUCER}'}
         )
         data = json.loads(response.data)
 
-        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertTrue(data['error'], 422)
-        self.assertEqual(data['message'], 'Unprocessable')
+        self.assertTrue(data['error'], 404)
+        self.assertEqual(data['message'], 'resource not found')
 
     def test_404_get_actor_by_id(self):
         response = self.client().get(
@@ -349,5 +758,164 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data['error'], 404)
         self.assertEqual(data['message'], 'resource not found')
 
+class CatalogSnapshotTestCase(unittest.TestCase):
+    """The in-memory catalog, without a database"""
+
+    def setUp(self):
+        self.snapshot = CatalogSnapshot()
+        self.version = 0
+
+    def movie_change(self, movie_id, title=None, release_date=None,
+                     row_version=1, version=None):
+        if version is None:
+            self.version += 1
+            version = self.version
+        row = None
+        if title is not None:
+            row = {"id": movie_id, "title": title, "version": row_version,
+                   "release_date": release_date}
+        return {"version": version, "table": "movies",
+                "op": "delete" if row is None else "update",
+                "id": movie_id, "row": row}
+
+    def test_out_of_order_versions(self):
+        self.snapshot.apply(self.movie_change(
+            1, "New", "2001-02-01T00:00:00", row_version=2, version=2
+        ))
+        self.assertEqual(self.snapshot.version, 0)
+        self.snapshot.apply(self.movie_change(
+            1, "Old", "2001-02-01T00:00:00", row_version=1, version=1
+        ))
+        self.assertEqual(self.snapshot.version, 2)
+        # the older row arrived last and is ignored
+        self.assertEqual(self.snapshot.get_movie(1).title, "New")
+        self.assertEqual(self.snapshot.all_movies(title="Old"), [])
+
+    def test_delete(self):
+        self.snapshot.apply(self.movie_change(1, "Gone", "2001-02-01"))
+        self.snapshot.apply(self.movie_change(1))
+        self.assertIsNone(self.snapshot.get_movie(1))
+        self.assertEqual(self.snapshot.all_movies(title="Gone"), [])
+        self.assertEqual(self.snapshot.movies_by_date, [])
+
+    def test_release_date_bounds(self):
+        for movie_id, day in [(1, "2001-01-31"), (2, "2001-02-01"),
+                              (3, "2001-02-01"), (4, "2001-02-28"),
+                              (5, "2001-03-01")]:
+            self.snapshot.apply(self.movie_change(
+                movie_id, "m{}".format(movie_id), day
+            ))
+        movies = self.snapshot.all_movies(
+            released_after=datetime(2001, 2, 1),
+            released_before=datetime(2001, 2, 28)
+        )
+        self.assertEqual([movie.id for movie in movies], [2, 3, 4])
+        movies = self.snapshot.all_movies(
+            released_before=datetime(2001, 1, 31)
+        )
+        self.assertEqual([movie.id for movie in movies], [1])
+
+    def test_rolled_back_versions_are_skipped(self):
+        self.snapshot.apply(self.movie_change(1, "One", "2001-02-01"))
+        # version 2 was handed out and rolled back
+        self.snapshot.apply(self.movie_change(
+            2, "Three", "2001-02-01", version=3
+        ))
+        self.assertIsNone(self.snapshot.missed_changes(3))
+        self.assertEqual(self.snapshot.missed_changes(3), 3)
+        self.snapshot.skip_to(3)
+        self.assertEqual(self.snapshot.version, 3)
+        self.assertIsNone(self.snapshot.missed_changes(3))
+        self.assertEqual(self.snapshot.checksums(), (0, 0, 0, 2, 3, 2))
+
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """Statement normalization and the per-request query profile"""
+
+    def test_normalize_collapses_values(self):
+        self.assertEqual(
+            normalize("SELECT movies_1.id\n  FROM movies AS movies_1 "
+                      "WHERE movies_1.id IN (%(id_1)s, %(id_2)s, %(id_3)s)"),
+            "SELECT movies_1.id FROM movies AS movies_1 "
+            "WHERE movies_1.id IN (...)"
+        )
+        self.assertEqual(
+            normalize("SELECT * FROM actors "
+                      "WHERE name = 'O''Brien' AND age > 42.5"),
+            "SELECT * FROM actors WHERE name = ? AND age > ?"
+        )
+        self.assertEqual(
+            normalize("INSERT INTO stats (metric, bucket) "
+                      "VALUES (%(m_0)s, %(b_0)s), (%(m_1)s, %(b_1)s)"),
+            "INSERT INTO stats (metric, bucket) VALUES (?, ?), ..."
+        )
+
+    def test_summarize_groups_statements(self):
+        profile = summarize([
+            ("SELECT a", 1.0), ("SELECT b", 2.0), ("SELECT a", 0.5)
+        ])
+        self.assertEqual(profile['queries'], 3)
+        self.assertEqual(profile['total_ms'], 3.5)
+        self.assertEqual(profile['statements'], [
+            {"statement": "SELECT a", "count": 2, "total_ms": 1.5},
+            {"statement": "SELECT b", "count": 1, "total_ms": 2.0}
+        ])
+
+    def test_possible_n_plus_one(self):
+        profile = summarize(
+            [("SELECT * FROM movies WHERE id = ?", 0.1)] * 5 +
+            [("select * from actors where id = ?", 0.1)] * 4 +
+            [("UPDATE stats SET count = ?", 0.1)] * 5
+        )
+        self.assertEqual(
+            [stat['statement'] for stat in possible_n_plus_one(profile, 5)],
+            ["SELECT * FROM movies WHERE id = ?"]
+        )
+        self.assertEqual(len(possible_n_plus_one(profile, 4)), 2)
+        self.assertEqual(possible_n_plus_one(summarize([]), 1), [])
+
+
+
+class SeedDataTestCase(unittest.TestCase):
+    """The synthetic data generators, without a database"""
+
+    def movies(self, seed, count, shard=0, jobs=1, **options):
+        rng = random.Random('{}:movies:{}'.format(seed, shard))
+        return list(generate_movies(rng, count, shard, jobs, **options))
+
+    def test_same_seed_same_rows(self):
+        self.assertEqual(
+            list(generate_actors(random.Random(1), 500)),
+            list(generate_actors(random.Random(1), 500))
+        )
+        self.assertEqual(self.movies(1, 500), self.movies(1, 500))
+        self.assertNotEqual(self.movies(1, 500), self.movies(2, 500))
+
+    def test_titles_unique_across_shards(self):
+        # far more movies than title bases, so most are sequels
+        titles = [
+            title
+            for shard in range(3)
+            for title, _ in self.movies(0, 3000, shard, 3)
+        ]
+        self.assertEqual(len(titles), 9000)
+        self.assertEqual(len(set(titles)), len(titles))
+
+    def test_titles_unique_after_title_offset(self):
+        existing = {title for title, _ in self.movies(0, 3000)}
+        # what seed_data.TITLE_OFFSET reads from the table
+        offset = max(
+            int(title.rsplit(' ', 1)[1])
+            if title.rsplit(' ', 1)[1].isdigit() else 1
+            for title in existing
+        )
+        added = [
+            title for title, _ in self.movies(1, 3000, title_offset=offset)
+        ]
+        self.assertEqual(len(set(added)), len(added))
+        self.assertFalse(existing & set(added))
+
+
 if __name__ == "__main__":
     unittest.main()